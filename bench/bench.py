@@ -0,0 +1,486 @@
+#!/usr/bin/env python3
+#  bench -- load tests and benchmarks for wurf
+
+"""Benchmark wurf on localhost
+
+Each mode starts a wurf server, drives concurrent clients through the
+redirect and download flow (or through multipart uploads), and reports
+throughput, latency percentiles, and the peak RSS and CPU time of the
+server as JSON.
+"""
+
+import sys, os, getopt, socket, subprocess, tempfile, time
+import http.client, json, math, platform, shutil, ssl, threading
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+WURF = os.path.join(HERE, os.pardir, "src", "wurf.py")
+
+DEFAULT_SIZES = "1K,1M,100M,1G"
+DEFAULT_MODES = "file,gzip,tls,dir-gz,dir-bz2,dir-xz,dir-zip,dir-tar,upload"
+DIR_FLAGS = {"gz": "-z", "bz2": "-j", "xz": "-J", "zip": "-Z", "tar": "-u"}
+TREE_FILES = 64
+READ_SIZE = 1024 * 1024
+SERVER_TIMEOUT = 30
+
+
+def parse_size(value: str) -> int:
+    """Parse a size in bytes, with an optional K, M or G suffix"""
+    value = value.strip()
+    multiplier = 1
+    if value[-1:].upper() in ("K", "M", "G"):
+        multiplier = 1024 ** ("KMG".index(value[-1].upper()) + 1)
+        value = value[:-1]
+    return int(float(value) * multiplier)
+
+
+def format_size(size: int) -> str:
+    for suffix, multiplier in (("G", 1024**3), ("M", 1024**2), ("K", 1024)):
+        if size >= multiplier and size % multiplier == 0:
+            return "%d%s" % (size // multiplier, suffix)
+    return str(size)
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of values"""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+# Test data: files of random bytes, text files that compress like real ones,
+# and a tree mixing both. A random block is repeated to fill large files,
+# which is fast and still out of reach of the compression windows.
+
+
+def write_random(path, size):
+    block = os.urandom(min(size, READ_SIZE))
+    with open(path, "wb") as datafile:
+        left = size
+        while left > 0:
+            datafile.write(block[:left])
+            left -= len(block)
+
+
+def write_text(path, size):
+    words = [
+        b"wurf", b"serves", b"files", b"over", b"http", b"to", b"browsers",
+        b"and", b"other", b"clients", b"once", b"or", b"several", b"times",
+    ]
+    lines = []
+    for i in range(4096):
+        lines.append(b"%d,%s,%s\n" % (i, words[i % len(words)], words[i * 7 % len(words)]))
+    block = b"".join(lines)
+    with open(path, "wb") as datafile:
+        left = size
+        while left > 0:
+            datafile.write(block[:left])
+            left -= len(block)
+
+
+def make_tree(path, size):
+    os.makedirs(path)
+    for i in range(TREE_FILES):
+        subdir = os.path.join(path, "dir%d" % (i % 8))
+        os.makedirs(subdir, exist_ok=True)
+        if i % 2:
+            write_random(os.path.join(subdir, "data%d.bin" % i), size // TREE_FILES)
+        else:
+            write_text(os.path.join(subdir, "data%d.csv" % i), size // TREE_FILES)
+
+
+def make_certificate(directory):
+    """Generate a self-signed certificate for localhost, returns its paths"""
+    cert = os.path.join(directory, "cert.pem")
+    key = os.path.join(directory, "key.pem")
+    subprocess.run(
+        [
+            "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+            "-keyout", key, "-out", cert, "-days", "1", "-subj", "/CN=localhost",
+            "-addext", "subjectAltName=DNS:localhost",
+        ],
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return cert, key
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# The server runs in a child process, so that its own resource usage can
+# be read from wait4() once it exits after serving its count of downloads.
+
+
+class Server:
+    def __init__(self, args, cwd, count):
+        self.port = free_port()
+        self.process = subprocess.Popen(
+            [sys.executable, WURF, "-i", "127.0.0.1", "-p", str(self.port), "-c", str(count)]
+            + args,
+            cwd=cwd,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        deadline = time.monotonic() + SERVER_TIMEOUT
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), 1).close()
+                return
+            except OSError:
+                if self.process.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError("wurf %s did not start" % " ".join(args))
+                time.sleep(0.05)
+
+    def wait(self):
+        """Wait for the server to exit, returns its resource usage"""
+        deadline = time.monotonic() + SERVER_TIMEOUT
+        while time.monotonic() < deadline:
+            pid, _, rusage = os.wait4(self.process.pid, os.WNOHANG)
+            if pid:
+                break
+            time.sleep(0.05)
+        else:
+            # Broken transfers don't count: the server may be waiting for more.
+            self.process.kill()
+            _, _, rusage = os.wait4(self.process.pid, 0)
+        self.process.returncode = 0
+        return rusage
+
+
+def connect(port, tls_context):
+    if tls_context:
+        return http.client.HTTPSConnection("localhost", port, context=tls_context)
+    return http.client.HTTPConnection("127.0.0.1", port)
+
+
+def download(port, tls_context, headers):
+    """Follow the redirect and download, returns (size, latency, ttfb)"""
+    start = time.perf_counter()
+    conn = connect(port, tls_context)
+    try:
+        conn.request("GET", "/", headers=headers)
+        response = conn.getresponse()
+        response.read()
+        location = response.getheader("Location") or "/"
+        conn.request("GET", location, headers=headers)
+        response = conn.getresponse()
+        ttfb = time.perf_counter() - start
+        if response.status != 200:
+            raise RuntimeError("status %d" % response.status)
+        size = 0
+        while True:
+            data = response.read(READ_SIZE)
+            if not data:
+                break
+            size += len(data)
+    finally:
+        conn.close()
+    return size, time.perf_counter() - start, ttfb
+
+
+def upload(port, tls_context, path):
+    """Send path as a multipart form, returns (size, latency, ttfb)"""
+    boundary = "wurfbench%d" % threading.get_ident()
+    head = (
+        '--%s\r\nContent-Disposition: form-data; name="upfile"; filename="%s"\r\n'
+        "Content-Type: application/octet-stream\r\n\r\n"
+        % (boundary, os.path.basename(path))
+    ).encode()
+    tail = ("\r\n--%s--\r\n" % boundary).encode()
+    size = os.path.getsize(path)
+
+    def body():
+        yield head
+        with open(path, "rb") as datafile:
+            while True:
+                data = datafile.read(READ_SIZE)
+                if not data:
+                    break
+                yield data
+        yield tail
+
+    start = time.perf_counter()
+    conn = connect(port, tls_context)
+    try:
+        conn.request(
+            "POST",
+            "/",
+            body=body(),
+            headers={
+                "Content-Type": "multipart/form-data; boundary=%s" % boundary,
+                "Content-Length": str(len(head) + size + len(tail)),
+            },
+        )
+        response = conn.getresponse()
+        ttfb = time.perf_counter() - start
+        response.read()
+        if response.status != 200:
+            raise RuntimeError("status %d" % response.status)
+    finally:
+        conn.close()
+    return size, time.perf_counter() - start, ttfb
+
+
+def run_clients(clients, rounds, request):
+    """Run clients threads doing rounds requests each, returns the samples"""
+    samples = []
+    errors = []
+    lock = threading.Lock()
+
+    def client():
+        for _ in range(rounds):
+            try:
+                sample = request()
+            except Exception as ex:
+                with lock:
+                    errors.append("%s: %s" % (type(ex).__name__, ex))
+            else:
+                with lock:
+                    samples.append(sample)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, errors, time.perf_counter() - start
+
+
+def run_mode(mode, size, workdir, clients, rounds, cert):
+    """Benchmark one mode with one size, returns its result"""
+    count = clients * rounds
+    tls_context = None
+    args = []
+    headers = {}
+    serve_dir = workdir
+    if mode == "tls":
+        tls_context = ssl.create_default_context(cafile=cert[0])
+        args += ["-t", "--cert", cert[0], "--key", cert[1]]
+
+    if mode in ("file", "tls"):
+        path = os.path.join(workdir, "random-%s.bin" % format_size(size))
+        if not os.path.exists(path):
+            write_random(path, size)
+        args.append(path)
+    elif mode == "gzip":
+        path = os.path.join(workdir, "text-%s.csv" % format_size(size))
+        if not os.path.exists(path):
+            write_text(path, size)
+        args += ["--encoding", "gzip", "--cache", "off", path]
+        headers["Accept-Encoding"] = "gzip"
+    elif mode.startswith("dir-"):
+        path = os.path.join(workdir, "tree-%s" % format_size(size))
+        if not os.path.exists(path):
+            make_tree(path, size)
+        args += [DIR_FLAGS[mode[4:]], "--cache", "off", path]
+    elif mode == "upload":
+        path = os.path.join(workdir, "random-%s.bin" % format_size(size))
+        if not os.path.exists(path):
+            write_random(path, size)
+        serve_dir = tempfile.mkdtemp(dir=workdir)
+        args.append("-U")
+    else:
+        raise ValueError("unknown mode: %s" % mode)
+
+    server = Server(args, serve_dir, count)
+    if mode == "upload":
+        request = lambda: upload(server.port, tls_context, path)
+    else:
+        request = lambda: download(server.port, tls_context, headers)
+    samples, errors, duration = run_clients(clients, rounds, request)
+    rusage = server.wait()
+    if serve_dir != workdir:
+        shutil.rmtree(serve_dir)
+
+    total = sum(sample[0] for sample in samples)
+    latencies = [sample[1] for sample in samples]
+    ttfbs = [sample[2] for sample in samples]
+    return {
+        "mode": mode,
+        "size": size,
+        "clients": clients,
+        "requests": len(samples),
+        "errors": len(errors),
+        "error_messages": errors[:5],
+        "bytes": total,
+        "seconds": duration,
+        "throughput_mbps": total / duration / 1e6 if duration else None,
+        "requests_per_second": len(samples) / duration if duration else None,
+        "latency_p50_ms": scale(percentile(latencies, 0.5), 1e3),
+        "latency_p99_ms": scale(percentile(latencies, 0.99), 1e3),
+        "ttfb_p50_ms": scale(percentile(ttfbs, 0.5), 1e3),
+        "ttfb_p99_ms": scale(percentile(ttfbs, 0.99), 1e3),
+        "server_peak_rss_kb": rusage.ru_maxrss,
+        "server_cpu_seconds": rusage.ru_utime + rusage.ru_stime,
+    }
+
+
+def scale(value, factor):
+    return None if value is None else value * factor
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "-C", HERE, "describe", "--always", "--dirty"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous, results):
+    """Print the throughput of results relative to a previous run"""
+    before = {(entry["mode"], entry["size"]): entry for entry in previous["results"]}
+    for entry in results:
+        old = before.get((entry["mode"], entry["size"]))
+        if not old or not old["throughput_mbps"] or not entry["throughput_mbps"]:
+            continue
+        print(
+            "%-8s %6s  %9.1f -> %9.1f MB/s (%+.1f%%)  p99 %8.1f -> %8.1f ms"
+            % (
+                entry["mode"],
+                format_size(entry["size"]),
+                old["throughput_mbps"],
+                entry["throughput_mbps"],
+                (entry["throughput_mbps"] / old["throughput_mbps"] - 1) * 100,
+                old["latency_p99_ms"],
+                entry["latency_p99_ms"],
+            ),
+            file=sys.stderr,
+        )
+
+
+def usage(errmsg=None):
+    name = os.path.basename(sys.argv[0])
+    print(
+        """
+    Usage: %s [-c <clients>] [-r <rounds>] [-s <sizes>] [-m <modes>]
+              [--tree-size <size>] [-d <dir>] [-o <output>] [--compare <file>]
+
+    Runs wurf on localhost for each mode and each size, with <clients>
+    concurrent clients doing <rounds> downloads or uploads each, and writes
+    the results as JSON to <output> or the standard output.
+
+    Sizes are given in bytes with an optional K, M or G suffix. Directory
+    modes serve a tree of <tree-size> bytes, half text and half random
+    data. The test data is generated in <dir>, kept there for the next
+    runs when given, and in a temporary directory otherwise.
+
+    Modes: file (plain download), gzip (download of a text file with
+    gzip Content-Encoding), tls (plain download over TLS, with a
+    self-signed certificate), dir-gz, dir-bz2, dir-xz, dir-zip, dir-tar
+    (directory archives) and upload (multipart uploads).
+
+    defaults: clients = 4, rounds = 3, sizes = %s, tree size = 64M,
+              modes = %s
+    """
+        % (name, DEFAULT_SIZES, DEFAULT_MODES),
+        file=sys.stderr,
+    )
+    if errmsg:
+        print("    %s\n" % errmsg, file=sys.stderr)
+        sys.exit(1)
+    sys.exit(0)
+
+
+def main():
+    clients = 4
+    rounds = 3
+    sizes = DEFAULT_SIZES
+    modes = DEFAULT_MODES
+    tree_size = "64M"
+    datadir = None
+    output = None
+    previous = None
+
+    try:
+        options, _ = getopt.gnu_getopt(
+            sys.argv[1:], "hc:r:s:m:d:o:", ["tree-size=", "compare="]
+        )
+    except getopt.GetoptError as desc:
+        usage(desc)
+
+    for option, val in options:
+        if option == "-c":
+            clients = int(val)
+        elif option == "-r":
+            rounds = int(val)
+        elif option == "-s":
+            sizes = val
+        elif option == "-m":
+            modes = val
+        elif option == "--tree-size":
+            tree_size = val
+        elif option == "-d":
+            datadir = val
+        elif option == "-o":
+            output = val
+        elif option == "--compare":
+            with open(val) as previous_file:
+                previous = json.load(previous_file)
+        elif option == "-h":
+            usage()
+
+    workdir = datadir or tempfile.mkdtemp(prefix="wurf-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    results = []
+    try:
+        cert = None
+        modes = [mode.strip() for mode in modes.split(",")]
+        if "tls" in modes:
+            cert = make_certificate(workdir)
+        for mode in modes:
+            mode_sizes = [tree_size] if mode.startswith("dir-") else sizes.split(",")
+            for size in mode_sizes:
+                result = run_mode(mode, parse_size(size), workdir, clients, rounds, cert)
+                print(
+                    "%-8s %6s  %9.1f MB/s  p50 %8.1f ms  p99 %8.1f ms  "
+                    "rss %7d KB  cpu %6.2f s  errors %d"
+                    % (
+                        mode,
+                        size,
+                        result["throughput_mbps"] or 0,
+                        result["latency_p50_ms"] or 0,
+                        result["latency_p99_ms"] or 0,
+                        result["server_peak_rss_kb"],
+                        result["server_cpu_seconds"],
+                        result["errors"],
+                    ),
+                    file=sys.stderr,
+                )
+                results.append(result)
+    finally:
+        if not datadir:
+            shutil.rmtree(workdir)
+
+    report = {
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "clients": clients,
+        "rounds": rounds,
+        "results": results,
+    }
+    if previous:
+        compare(previous, results)
+    if output:
+        with open(output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
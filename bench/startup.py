@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+#  startup -- startup time benchmark for wurf
+
+"""Measure how fast wurf starts
+
+The import time of the wurf module is read from python -X importtime,
+and the time to listen from starting wurf on a file to its "Now serving"
+line. Both are checked against a budget, so that a slow import sneaking
+in makes the benchmark fail.
+"""
+
+import sys, os, getopt, socket, statistics, subprocess, tempfile, time
+import json
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(HERE, os.pardir, "src")
+
+DEFAULT_RUNS = 20
+DEFAULT_IMPORT_BUDGET = 100
+DEFAULT_LISTEN_BUDGET = 250
+
+
+def import_time() -> float:
+    """Cumulative import time of the wurf module, in milliseconds"""
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-X",
+            "importtime",
+            "-c",
+            "import sys; sys.path.insert(0, %r); import wurf" % SRC,
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    for line in reversed(result.stderr.splitlines()):
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].strip() == "wurf":
+            return int(fields[1]) / 1e3
+    raise RuntimeError("no import time for wurf in: %s" % result.stderr)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def listen_time(filename, args) -> float:
+    """Time from starting wurf to its "Now serving" line, in milliseconds
+
+    wurf is started as the installed script does it, importing the module.
+    """
+    port = free_port()
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            "import sys; sys.path.insert(0, %r); import wurf; wurf.main()" % SRC,
+            "-i",
+            "127.0.0.1",
+            "-p",
+            str(port),
+            "-c",
+            "1",
+        ]
+        + args
+        + [filename],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        env=dict(os.environ, PYTHONUNBUFFERED="1"),
+    )
+    try:
+        line = process.stdout.readline()
+        elapsed = time.perf_counter() - start
+        if not line.startswith(b"Now serving"):
+            raise RuntimeError("wurf did not start: %r" % line)
+    finally:
+        process.kill()
+        process.wait()
+    return elapsed * 1e3
+
+
+def summary(values):
+    return {"min": min(values), "median": statistics.median(values), "max": max(values)}
+
+
+def usage(errmsg=None):
+    name = os.path.basename(sys.argv[0])
+    print(
+        """
+    Usage: %s [-r <runs>] [--import-budget <ms>] [--listen-budget <ms>] [-o <output>]
+
+    Starts wurf <runs> times, and measures the import time of the wurf
+    module and the time until it listens, serving a small file. Writes
+    the results as JSON to <output> or the standard output, and exits
+    with status 1 when the median of either goes over its budget.
+
+    defaults: runs = %d, import budget = %d ms, listen budget = %d ms
+    """
+        % (name, DEFAULT_RUNS, DEFAULT_IMPORT_BUDGET, DEFAULT_LISTEN_BUDGET),
+        file=sys.stderr,
+    )
+    if errmsg:
+        print("    %s\n" % errmsg, file=sys.stderr)
+        sys.exit(2)
+    sys.exit(0)
+
+
+def main():
+    runs = DEFAULT_RUNS
+    import_budget = DEFAULT_IMPORT_BUDGET
+    listen_budget = DEFAULT_LISTEN_BUDGET
+    output = None
+
+    try:
+        options, _ = getopt.gnu_getopt(
+            sys.argv[1:], "hr:o:", ["import-budget=", "listen-budget="]
+        )
+        for option, val in options:
+            if option == "-r":
+                runs = int(val)
+            elif option == "--import-budget":
+                import_budget = float(val)
+            elif option == "--listen-budget":
+                listen_budget = float(val)
+            elif option == "-o":
+                output = val
+            elif option == "-h":
+                usage()
+    except (getopt.GetoptError, ValueError) as desc:
+        usage(desc)
+
+    with tempfile.NamedTemporaryFile(suffix=".bin") as datafile:
+        datafile.write(os.urandom(1024))
+        datafile.flush()
+        imports = [import_time() for _ in range(runs)]
+        listens = [listen_time(datafile.name, []) for _ in range(runs)]
+        listens_no_discover = [
+            listen_time(datafile.name, ["--no-discover"]) for _ in range(runs)
+        ]
+
+    report = {
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": sys.version.split()[0],
+        "runs": runs,
+        "import_ms": summary(imports),
+        "listen_ms": summary(listens),
+        "listen_no_discover_ms": summary(listens_no_discover),
+        "import_budget_ms": import_budget,
+        "listen_budget_ms": listen_budget,
+    }
+    report["within_budget"] = (
+        report["import_ms"]["median"] <= import_budget
+        and report["listen_ms"]["median"] <= listen_budget
+    )
+
+    print(
+        "import %.1f ms (budget %.0f), listening after %.1f ms (budget %.0f)"
+        % (
+            report["import_ms"]["median"],
+            import_budget,
+            report["listen_ms"]["median"],
+            listen_budget,
+        ),
+        file=sys.stderr,
+    )
+    if output:
+        with open(output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    sys.exit(0 if report["within_budget"] else 1)
+
+
+if __name__ == "__main__":
+    main()
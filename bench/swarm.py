@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+#  swarm -- distribution benchmark for wurf swarms
+
+"""Measure how long it takes to hand a file out to many clients
+
+A wurf server with its bandwidth capped, standing for the uplink of the
+machine serving a rollout, serves a file to N wurf clients started at
+once, first on its own and then with --swarm. The distribution time is
+the time until the last client has a verified copy of the file.
+"""
+
+import sys, os, getopt, re, socket, statistics, subprocess, tempfile, threading, time
+import json
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+WURF = os.path.join(HERE, os.pardir, "src", "wurf.py")
+
+DEFAULT_CLIENTS = 8
+DEFAULT_SIZE = "100M"
+DEFAULT_RATE = "20M"
+SERVER_TIMEOUT = 30
+
+
+def parse_size(value: str) -> int:
+    """Parse a size in bytes, with an optional K, M or G suffix"""
+    value = value.strip()
+    multiplier = 1
+    if value[-1:].upper() in ("K", "M", "G"):
+        multiplier = 1024 ** ("KMG".index(value[-1].upper()) + 1)
+        value = value[:-1]
+    return int(float(value) * multiplier)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def watch(process, pattern, found):
+    """Read the output of process, noting when a line matches pattern"""
+    for line in process.stdout:
+        match = re.match(pattern, line.decode("utf-8", "replace"))
+        if match:
+            found.append((time.perf_counter(), match))
+
+
+def distribute(workdir, datafile, clients, rate, swarm) -> dict:
+    """Serve datafile to clients wurf clients at once, with or without a swarm"""
+    flags = ["--swarm"] if swarm else []
+    port = free_port()
+    env = dict(os.environ, PYTHONUNBUFFERED="1")
+    server = subprocess.Popen(
+        [sys.executable, WURF, "-i", "127.0.0.1", "-p", str(port), "-c", str(clients)]
+        + ["--rate", rate]
+        + flags
+        + [datafile],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        env=env,
+    )
+    server_lines = []
+    server_thread = threading.Thread(
+        target=watch, args=(server, r"(Now serving|Sent (\d+) bytes)", server_lines)
+    )
+    server_thread.start()
+    deadline = time.monotonic() + SERVER_TIMEOUT
+    while not server_lines and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    start = time.perf_counter()
+    processes = []
+    for i in range(clients):
+        directory = os.path.join(workdir, "%s-%d" % ("swarm" if swarm else "origin", i))
+        os.makedirs(directory)
+        process = subprocess.Popen(
+            [sys.executable, WURF, "--batch"] + flags + ["http://127.0.0.1:%d/" % port],
+            cwd=directory,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            env=env,
+        )
+        done = []
+        thread = threading.Thread(target=watch, args=(process, r"sha-256 \w+ verified", done))
+        thread.start()
+        processes.append((process, thread, done))
+
+    finished = []
+    for process, thread, done in processes:
+        process.wait()
+        thread.join()
+        if not done:
+            raise RuntimeError("a client failed, see %s" % workdir)
+        finished.append(done[0][0] - start)
+    server.wait(SERVER_TIMEOUT)
+    server_thread.join()
+
+    sent = [int(match.group(2)) for _, match in server_lines if match.group(2)]
+    return {
+        "distribution_s": max(finished),
+        "client_s": {
+            "min": min(finished),
+            "median": statistics.median(finished),
+            "max": max(finished),
+        },
+        "server_sent_bytes": sent[0] if sent else None,
+    }
+
+
+def usage(errmsg=None):
+    name = os.path.basename(sys.argv[0])
+    print(
+        """
+    Usage: %s [-c <clients>] [-s <size>] [--rate <rate>] [-d <dir>] [-o <output>]
+
+    Serves a file of <size> bytes of random data to <clients> wurf clients
+    at once, from a wurf server capped at <rate> bytes per second, first
+    without and then with --swarm. Writes the distribution times and the
+    bytes sent by the server as JSON to <output> or the standard output.
+    The test files go to a temporary directory under <dir>.
+
+    defaults: clients = %d, size = %s, rate = %s
+    """
+        % (name, DEFAULT_CLIENTS, DEFAULT_SIZE, DEFAULT_RATE),
+        file=sys.stderr,
+    )
+    if errmsg:
+        print("    %s\n" % errmsg, file=sys.stderr)
+        sys.exit(2)
+    sys.exit(0)
+
+
+def main():
+    clients = DEFAULT_CLIENTS
+    size = parse_size(DEFAULT_SIZE)
+    rate = DEFAULT_RATE
+    basedir = None
+    output = None
+
+    try:
+        options, _ = getopt.gnu_getopt(sys.argv[1:], "hc:s:d:o:", ["rate="])
+        for option, val in options:
+            if option == "-c":
+                clients = int(val)
+            elif option == "-s":
+                size = parse_size(val)
+            elif option == "--rate":
+                rate = val
+            elif option == "-d":
+                basedir = val
+            elif option == "-o":
+                output = val
+            elif option == "-h":
+                usage()
+    except (getopt.GetoptError, ValueError) as desc:
+        usage(desc)
+
+    with tempfile.TemporaryDirectory(prefix="wurf-swarm-", dir=basedir) as workdir:
+        datafile = os.path.join(workdir, "image.bin")
+        with open(datafile, "wb") as f:
+            f.write(os.urandom(size))
+        origin = distribute(workdir, datafile, clients, rate, False)
+        swarm = distribute(workdir, datafile, clients, rate, True)
+
+    report = {
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": sys.version.split()[0],
+        "clients": clients,
+        "size": size,
+        "rate": rate,
+        "origin": origin,
+        "swarm": swarm,
+        "speedup": origin["distribution_s"] / swarm["distribution_s"],
+    }
+    print(
+        "%d clients: %.1f s from the server alone, %.1f s with the swarm (%.1fx)"
+        % (clients, origin["distribution_s"], swarm["distribution_s"], report["speedup"]),
+        file=sys.stderr,
+    )
+    if output:
+        with open(output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
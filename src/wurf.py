@@ -4,21 +4,40 @@
 
 from __future__ import annotations
 
-from typing import Generator, BinaryIO
-
-import sys, os, errno, socket, getopt, subprocess, tempfile
-import urllib.request, urllib.parse, http.server
-import email.parser
-import readline
+# Annotations are never evaluated: typing is only imported by type checkers.
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from typing import Generator, BinaryIO
+
+# Only the modules a plain file transfer needs are imported here, wurf gets
+# started from scripts and its startup time counts. The client, archives,
+# the cache and uploads import theirs when they are first used.
+import sys, os, errno, socket, getopt, time
+import atexit, base64, contextlib, hashlib, queue, threading
+import urllib.parse, http.server
+import email.parser, email.utils
 import configparser
-import shutil, tarfile, zipfile
-import struct
-from io import BytesIO, StringIO
+import shutil
+import struct, zlib
+import collections, concurrent.futures, itertools
+import html, json
 import ssl
 
-maxdownloads = 1
-cpid = -1
+maxtransfers = 100
+workers = 1
+discover = True
+swarm = False
+tracer = None
+profile_dir = None
+rate = None
+client_rate = None
+browse = False
 compressed = "gz"
+encoding = "off"
+level = None
+cache = "on"
+archive_cache = None
+threads = os.cpu_count() or 1
 upload = False
 tls = False
 cert = ""
@@ -38,49 +57,2225 @@ def find_ip():
     # We're doing multiple tests, to guard against the computer being
     # part of a test installation.
 
+    # Without a route to them, as on an offline host, there is no answer.
+
     candidates = []
     for test_ip in ["192.0.2.0", "198.51.100.0", "203.0.113.0"]:
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect((test_ip, 80))
-        ip_addr = s.getsockname()[0]
-        s.close()
+        try:
+            s.connect((test_ip, 80))
+            ip_addr = s.getsockname()[0]
+        except OSError:
+            continue
+        finally:
+            s.close()
         if ip_addr in candidates:
             return ip_addr
         candidates.append(ip_addr)
 
-    return candidates[0]
+    return candidates[0] if candidates else None
+
+
+# Multipart bodies are parsed as a stream: the request body is read in
+# chunks of MULTIPART_CHUNK_SIZE bytes, so an upload never has to fit in
+# memory, whatever its size.
+
+MULTIPART_CHUNK_SIZE = 256 * 1024
+MULTIPART_MAX_HEADER_SIZE = 64 * 1024
 
 
 def decode_multipart_form_data(
     multipart_data: BinaryIO, headers: email.message.Message
-) -> list[tuple[dict[str, str], bytes]]:
-    """Decode multipart form data"""
-    content_type = headers["Content-Type"].encode("ascii")
-    content_len = int(headers["Content-Length"])
-    data = multipart_data.read(content_len)
+) -> Generator[tuple[dict[str, str], Generator[bytes, None, None]], None, None]:
+    """Decode multipart form data
+
+    Yields a (params, chunks) tuple for each part, where params are the
+    Content-Disposition parameters and chunks iterates over the part body.
+    A part body not consumed by the caller is skipped when the next part
+    is requested. Raises ValueError on a malformed or truncated body.
+    """
+    boundary = headers.get_param("boundary")
+    if not boundary or headers["Content-Length"] is None:
+        raise ValueError("not a multipart body with a known length")
+
+    remaining = int(headers["Content-Length"])
+    delimiter = b"\r\n--" + boundary.encode("latin-1")
+
+    # The leading CRLF lets the first boundary match the delimiter too.
+    buf = bytearray(b"\r\n")
+
+    def fill(need):
+        nonlocal remaining
+        while len(buf) < need:
+            if remaining <= 0:
+                raise ValueError("truncated multipart body")
+            data = multipart_data.read(min(MULTIPART_CHUNK_SIZE, remaining))
+            if not data:
+                raise ValueError("truncated multipart body")
+            remaining -= len(data)
+            buf.extend(data)
+
+    def read_until(marker, limit=None):
+        # Yields the data up to marker, keeping back just enough bytes
+        # to recognize a marker split across two reads.
+        keep = len(marker) - 1
+        seen = 0
+        while True:
+            pos = buf.find(marker)
+            if pos >= 0:
+                if pos:
+                    yield bytes(buf[:pos])
+                del buf[: pos + len(marker)]
+                return
+            if len(buf) > keep:
+                size = len(buf) - keep
+                seen += size
+                if limit is not None and seen > limit:
+                    raise ValueError("multipart headers too large")
+                yield bytes(buf[:size])
+                del buf[:size]
+            fill(len(buf) + 1)
+
+    for _ in read_until(delimiter):
+        pass  # preamble
+
+    while True:
+        fill(2)
+        if buf[:2] == b"--":
+            break
+
+        header_block = b"".join(read_until(b"\r\n\r\n", MULTIPART_MAX_HEADER_SIZE))
+        part = email.parser.BytesParser().parsebytes(
+            header_block.lstrip(b" \t").partition(b"\r\n")[2], headersonly=True
+        )
+        params = part.get_params(header="content-disposition", failobj=[])
+
+        body = read_until(delimiter)
+        yield dict(params), body
+        for _ in body:
+            pass
+
+    # Drain the epilogue, so the connection is left at the end of the body.
+    while remaining > 0:
+        data = multipart_data.read(min(MULTIPART_CHUNK_SIZE, remaining))
+        if not data:
+            break
+        remaining -= len(data)
+
+
+def read_body(
+    rfile: BinaryIO, headers: email.message.Message
+) -> Generator[bytes, None, None]:
+    """Iterate over the chunks of a request body, of known length or chunked
+
+    Raises ValueError on a malformed or truncated body.
+    """
+    if "chunked" not in (headers["Transfer-Encoding"] or "").lower():
+        remaining = int(headers["Content-Length"] or 0)
+        while remaining > 0:
+            data = rfile.read(min(MULTIPART_CHUNK_SIZE, remaining))
+            if not data:
+                raise ValueError("truncated body")
+            remaining -= len(data)
+            yield data
+        return
+
+    while True:
+        line = rfile.readline(MULTIPART_MAX_HEADER_SIZE)
+        if not line.endswith(b"\n"):
+            raise ValueError("truncated chunked body")
+        size = int(line.split(b";")[0], 16)
+        if size == 0:
+            break
+        while size > 0:
+            data = rfile.read(min(MULTIPART_CHUNK_SIZE, size))
+            if not data:
+                raise ValueError("truncated chunked body")
+            size -= len(data)
+            yield data
+        if rfile.readline(MULTIPART_MAX_HEADER_SIZE).strip():
+            raise ValueError("malformed chunked body")
+    # Skip the trailer fields.
+    while rfile.readline(MULTIPART_MAX_HEADER_SIZE).strip():
+        pass
+
+
+class CountingWriter:
+    """File-like object counting the bytes written through it"""
+
+    def __init__(self, fileobj: BinaryIO):
+        self.fileobj = fileobj
+        self.count = 0
+
+    def write(self, data):
+        self.count += len(data)
+        return self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+class ChunkedWriter:
+    """File-like object framing the data written with chunked encoding"""
+
+    def __init__(self, fileobj: BinaryIO):
+        self.fileobj = fileobj
+
+    def write(self, data):
+        # An empty chunk would end the body.
+        if data:
+            self.fileobj.write(b"%x\r\n%b\r\n" % (len(data), data))
+        return len(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        self.fileobj.write(b"0\r\n\r\n")
+
+
+# Byte ranges (RFC 9110, section 14) let clients resume an interrupted
+# download or fetch a file in several segments. Ranges only apply to
+# regular files: directory archives are generated on the fly.
+
+MAX_RANGES = 16
+
+
+def parse_byte_ranges(header: str, size: int) -> list[tuple[int, int]] | None:
+    """Parse a Range header against a representation of size bytes
+
+    Returns a list of (first, last) inclusive byte positions, or None when
+    the header is invalid or not about bytes, in which case it must be
+    ignored. Raises ValueError when no range is satisfiable.
+    """
+    unit, sep, spec = header.partition("=")
+    if not sep or unit.strip().lower() != "bytes":
+        return None
+
+    ranges = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        first, sep, last = item.partition("-")
+        first, last = first.strip(), last.strip()
+        if not sep or not (first.isdigit() or last.isdigit()):
+            return None
+        if (first and not first.isdigit()) or (last and not last.isdigit()):
+            return None
+
+        if not first:
+            # Suffix range: the last bytes of the file
+            if int(last) > 0 and size > 0:
+                ranges.append((max(size - int(last), 0), size - 1))
+            continue
+
+        first = int(first)
+        if last and int(last) < first:
+            return None
+        if first < size:
+            last = int(last) if last else size - 1
+            ranges.append((first, min(last, size - 1)))
+
+    if len(ranges) > MAX_RANGES:
+        return None
+    if not ranges:
+        raise ValueError("unsatisfiable range")
+    return ranges
+
+
+def file_validators(st: os.stat_result) -> tuple[str, str]:
+    """Return the (ETag, Last-Modified) validators for a stat result"""
+    etag = '"%x-%x"' % (st.st_mtime_ns, st.st_size)
+    return etag, email.utils.formatdate(st.st_mtime, usegmt=True)
+
+
+# Files are also identified by their SHA-256 digest, sent as ETag and in the
+# Repr-Digest and Digest headers, so that clients can check what they got.
+# Hashing a large file takes a while, so it's done on a background thread,
+# once per version of the file: responses never wait for it, they only
+# include the digest once it's known.
+
+DIGEST_CACHE_SIZE = 1024
+DIGEST_BUFFER_SIZE = 1024 * 1024
+
+
+def sha256_file(path: str, digest=None) -> hashlib._Hash:
+    """Hash the contents of the path file, updating digest if given"""
+    digest = digest or hashlib.sha256()
+    buffer = bytearray(DIGEST_BUFFER_SIZE)
+    view = memoryview(buffer)
+    with open(path, "rb") as f:
+        for read in iter(lambda: f.readinto(buffer), 0):
+            digest.update(view[:read])
+    return digest
+
+
+def digest_etag(digest: bytes) -> str:
+    return '"sha256-%s"' % digest.hex()
+
+
+def digest_headers(digest: bytes) -> list[tuple[str, str]]:
+    value = base64.b64encode(digest).decode("ascii")
+    return [("Repr-Digest", "sha-256=:%s:" % value), ("Digest", "sha-256=%s" % value)]
+
+
+def parse_digest(
+    headers: email.message.Message, names=("Repr-Digest", "Content-Digest", "Digest")
+) -> bytes | None:
+    """Return the SHA-256 digest given by the Repr-Digest or Digest header"""
+    for name in names:
+        for item in (headers[name] or "").split(","):
+            algorithm, _, value = item.strip().partition("=")
+            if algorithm.lower() == "sha-256":
+                try:
+                    return base64.b64decode(value.strip(":"), validate=True)
+                except ValueError:
+                    pass
+    return None
+
+
+class DigestCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.digests = collections.OrderedDict()
+        self.pending = queue.Queue()
+        self.thread = None
+
+    def lookup(self, path: str, st: os.stat_result) -> bytes | None:
+        """Return the digest of the file, or None if it isn't known yet"""
+        key = (path, st.st_ino, st.st_size, st.st_mtime_ns)
+        with self.lock:
+            if key in self.digests:
+                self.digests.move_to_end(key)
+                return self.digests[key]
+            self.digests[key] = None
+            if len(self.digests) > DIGEST_CACHE_SIZE:
+                self.digests.popitem(last=False)
+            # Started with the first file to hash, after the workers are
+            # forked. A daemon thread, so that exiting doesn't wait for a
+            # large file.
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        self.pending.put(key)
+        return None
+
+    def run(self):
+        while True:
+            key = self.pending.get()
+            try:
+                digest = sha256_file(key[0])
+                st = os.stat(key[0])
+            except OSError:
+                st = None
+            with self.lock:
+                # Forget about a file modified while it was hashed.
+                if st is None or (st.st_ino, st.st_size, st.st_mtime_ns) != key[1:]:
+                    self.digests.pop(key, None)
+                elif key in self.digests:
+                    self.digests[key] = digest.digest()
+
+
+# A client updating an older copy of a file first fetches its manifest: the
+# file cut in blocks, each with an Adler-32 checksum, which can be rolled
+# along the local copy a byte at a time, and a BLAKE2b digest to confirm a
+# match, plus the SHA-256 digest of the whole file. The client then only
+# downloads the blocks it doesn't have, the way rsync does. Blocks are
+# hashed on the thread pool, and the manifest of each version of a file is
+# kept, so that repeat clients don't wait for the file to be hashed again.
+
+MANIFEST_TYPE = "application/x-wurf-manifest"
+MANIFEST_MAGIC = b"WURFMAN1"
+MANIFEST_HEADER = struct.Struct("!8sIQ32s")
+MANIFEST_BLOCK = struct.Struct("!I16s")
+MANIFEST_CACHE_SIZE = 16
+DELTA_MIN_BLOCK_SIZE = 64 * 1024
+DELTA_MAX_BLOCKS = 64 * 1024
+
+
+def delta_block_size(size: int) -> int:
+    """Block size of the manifest of a size bytes file"""
+    block_size = DELTA_MIN_BLOCK_SIZE
+    while block_size * DELTA_MAX_BLOCKS < size:
+        block_size *= 2
+    return block_size
+
+
+def block_checksums(block: bytes) -> bytes:
+    """The manifest entry of a block: its weak and strong checksums"""
+    return MANIFEST_BLOCK.pack(
+        zlib.adler32(block), hashlib.blake2b(block, digest_size=16).digest()
+    )
+
+
+def block_manifest(path: str, block_size: int | None = None) -> bytes:
+    """Build the manifest of the path file, in blocks of block_size bytes"""
+    digest = hashlib.sha256()
+    entries = []
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        block_size = block_size or delta_block_size(size)
+        blocks = iter(lambda: f.read(block_size), b"")
+        with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+            for block, entry in imap_ordered(
+                pool, lambda block: (block, block_checksums(block)), blocks, 2 * threads
+            ):
+                digest.update(block)
+                entries.append(entry)
+    header = MANIFEST_HEADER.pack(MANIFEST_MAGIC, block_size, size, digest.digest())
+    return header + b"".join(entries)
+
+
+def parse_manifest(data: bytes) -> tuple[int, int, bytes, list[tuple[int, bytes]]]:
+    """Return the block size, file size, digest and blocks of a manifest"""
+    if len(data) < MANIFEST_HEADER.size:
+        raise ValueError("truncated manifest")
+    magic, block_size, size, digest = MANIFEST_HEADER.unpack_from(data)
+    if magic != MANIFEST_MAGIC or not block_size:
+        raise ValueError("not a wurf manifest")
+    entries = data[MANIFEST_HEADER.size :]
+    if len(entries) != -(-size // block_size) * MANIFEST_BLOCK.size:
+        raise ValueError("manifest doesn't match the file size")
+    return block_size, size, digest, list(MANIFEST_BLOCK.iter_unpack(entries))
+
+
+class ManifestCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.manifests = collections.OrderedDict()
+
+    def get(self, path: str, block_size: int | None = None) -> bytes:
+        """Return the manifest of the path file, building it if needed
+
+        Clients asking for a manifest being built wait for it.
+        """
+        st = os.stat(path)
+        key = (path, st.st_ino, st.st_size, st.st_mtime_ns, block_size)
+        with self.lock:
+            future = self.manifests.get(key)
+            build = future is None
+            if build:
+                future = self.manifests[key] = concurrent.futures.Future()
+                if len(self.manifests) > MANIFEST_CACHE_SIZE:
+                    self.manifests.popitem(last=False)
+            else:
+                self.manifests.move_to_end(key)
+        if build:
+            try:
+                future.set_result(block_manifest(path, block_size))
+            except Exception as ex:
+                future.set_exception(ex)
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+            # Forget about a file modified while it was hashed.
+            if st is None or (st.st_ino, st.st_size, st.st_mtime_ns) != key[1:4]:
+                with self.lock:
+                    if self.manifests.get(key) is future:
+                        del self.manifests[key]
+        return future.result()
+
+
+# With --swarm, the server is also the tracker of a swarm of clients passing
+# the file on to each other. A GET on SWARM_PATH returns the swarm document:
+# the size of the file, its SHA-256 digest, and the size and checksums of
+# its chunks, taken from a manifest. Peers announce themselves with a POST
+# of the port they serve chunks on and of the chunks they have, and get
+# back the other peers and their chunks, and the chunks the server would
+# rather send them itself: the rarest ones, that no peer has and that no
+# other peer was handed lately. Most chunks thus leave the server once, the
+# peers passing them on. Peers that stop announcing are forgotten.
+
+SWARM_PATH = "/_wurf/swarm"
+SWARM_MIN_CHUNK_SIZE = 1024 * 1024
+SWARM_MAX_CHUNKS = 1024
+SWARM_MAX_ANNOUNCE_SIZE = 64 * 1024
+SWARM_PEER_TIMEOUT = 10
+SWARM_ASSIGN_TIMEOUT = 5
+
+
+def swarm_chunk_size(size: int) -> int:
+    """Chunk size of the swarm of a size bytes file"""
+    chunk_size = SWARM_MIN_CHUNK_SIZE
+    while chunk_size * SWARM_MAX_CHUNKS < size:
+        chunk_size *= 2
+    return chunk_size
+
+
+class Swarm:
+    def __init__(self, filename: str, manifests: ManifestCache):
+        self.filename = filename
+        self.manifests = manifests
+        size = os.path.getsize(filename)
+        self.chunk_size = swarm_chunk_size(size)
+        self.count = -(-size // self.chunk_size)
+        self.lock = threading.Lock()
+        self.peers = {}
+        self.holders = collections.Counter()
+        self.assigned = {}
+
+    def document(self) -> dict:
+        manifest = self.manifests.get(self.filename, self.chunk_size)
+        chunk_size, size, digest, blocks = parse_manifest(manifest)
+        return {
+            "size": size,
+            "digest": digest.hex(),
+            "chunk_size": chunk_size,
+            "chunks": [strong.hex() for weak, strong in blocks],
+        }
+
+    def count_chunks(self, chunks: int, increment: int):
+        while chunks:
+            low = chunks & -chunks
+            self.holders[low.bit_length() - 1] += increment
+            chunks ^= low
+
+    def announce(self, url: str, have: int, want: int, leave=False) -> dict:
+        """Register the chunks a peer has, returns what it should fetch where
+
+        The last chunk is never handed out: it comes from the server last,
+        to count the download.
+        """
+        now = time.monotonic()
+        with self.lock:
+            for peer, (peer_have, seen) in list(self.peers.items()):
+                if peer == url or seen < now - SWARM_PEER_TIMEOUT:
+                    del self.peers[peer]
+                    self.count_chunks(peer_have, -1)
+            if leave:
+                return {"peers": [], "assign": []}
+            self.peers[url] = (have, now)
+            self.count_chunks(have, 1)
+            for chunk, expiry in list(self.assigned.items()):
+                if expiry < now or self.holders[chunk]:
+                    del self.assigned[chunk]
+
+            assign = []
+            for chunk in range(self.count - 1):
+                if len(assign) >= want:
+                    break
+                if not have >> chunk & 1 and not self.holders[chunk]:
+                    if chunk not in self.assigned:
+                        assign.append(chunk)
+                        self.assigned[chunk] = now + SWARM_ASSIGN_TIMEOUT
+            peers = [
+                {"url": peer, "have": "%x" % peer_have}
+                for peer, (peer_have, seen) in self.peers.items()
+                if peer != url
+            ]
+        return {"peers": peers, "assign": assign}
+
+
+# Single files are sent with sendfile(2) on plain connections, so the data
+# goes from the page cache to the socket without a copy through userspace.
+# With TLS the ssl module has to encrypt the data, so we copy it through a
+# single reused buffer of COPY_BUFFER_SIZE bytes instead.
+
+COPY_BUFFER_SIZE = 256 * 1024
+
+
+def send_file(
+    datafile: BinaryIO, sock: socket.socket, offset=0, count=None, throttle=None
+) -> int:
+    """Send count bytes of datafile, starting at offset, to sock
+
+    Returns the number of bytes sent, which is less than count if the
+    file got shorter in the meantime.
+    """
+    if throttle is not None:
+        total_sent = 0
+        while count is None or total_sent < count:
+            size = RATE_QUANTUM
+            if count is not None:
+                size = min(size, count - total_sent)
+            throttle.consume(size)
+            sent = send_file(datafile, sock, offset + total_sent, size)
+            if not sent:
+                break
+            total_sent += sent
+        return total_sent
+
+    if not isinstance(sock, ssl.SSLSocket):
+        return sock.sendfile(datafile, offset, count)
+
+    datafile.seek(offset)
+    buffer = bytearray(min(count or COPY_BUFFER_SIZE, COPY_BUFFER_SIZE))
+    view = memoryview(buffer)
+    total_sent = 0
+    while count is None or total_sent < count:
+        size = COPY_BUFFER_SIZE
+        if count is not None:
+            size = min(size, count - total_sent)
+        read = datafile.readinto(view[:size])
+        if not read:
+            break
+        sock.sendall(view[:read])
+        total_sent += read
+    return total_sent
+
+
+# Transfers can be rate limited, with a cap on the total bandwidth and one
+# per client. Each cap is a token bucket: a transfer takes RATE_QUANTUM
+# bytes worth of tokens before sending or receiving them, going into debt
+# if there aren't enough, and sleeps until the debt is paid off. A transfer
+# asking for tokens thus waits behind the ones that asked before it, so the
+# active transfers take turns and share the bandwidth evenly.
+
+RATE_QUANTUM = 64 * 1024
+
+
+def parse_rate(value: str) -> int:
+    """Parse a rate in bytes per second, with an optional k, M or G suffix"""
+    value = value.strip()
+    multiplier = 1
+    if value[-1:].lower() in ("k", "m", "g"):
+        multiplier = 1024 ** ("kmg".index(value[-1].lower()) + 1)
+        value = value[:-1]
+    rate = int(float(value) * multiplier)
+    if rate <= 0:
+        raise ValueError("rate must be positive")
+    return rate
+
+
+class TokenBucket:
+    def __init__(self, rate: int):
+        self.rate = rate
+        # Up to a tenth of a second of unused bandwidth is saved up.
+        self.capacity = max(rate / 10, RATE_QUANTUM)
+        self.tokens = self.capacity
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount: int) -> float:
+        """Take amount tokens, returns how long to wait before using them"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= amount
+            return max(0.0, -self.tokens / self.rate)
+
+
+class Throttle:
+    """The token buckets a connection draws from"""
+
+    def __init__(self, *buckets: TokenBucket):
+        self.buckets = buckets
+
+    def consume(self, amount: int):
+        delay = max(bucket.reserve(amount) for bucket in self.buckets)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class ThrottledReader:
+    """File-like object reading from fileobj at the pace of a Throttle
+
+    Reads return at most RATE_QUANTUM bytes, like reads from a socket.
+    """
+
+    def __init__(self, fileobj: BinaryIO, throttle: Throttle):
+        self.fileobj = fileobj
+        self.throttle = throttle
+
+    def read(self, size=-1):
+        data = self.fileobj.read(min(size, RATE_QUANTUM) if size >= 0 else RATE_QUANTUM)
+        self.throttle.consume(len(data))
+        return data
+
+    def readline(self, size=-1):
+        line = self.fileobj.readline(size)
+        self.throttle.consume(len(line))
+        return line
+
+    def peek(self, size=0):
+        return self.fileobj.peek(size)
+
+    @property
+    def closed(self):
+        return self.fileobj.closed
+
+    def close(self):
+        self.fileobj.close()
+
+
+class ThrottledWriter:
+    """File-like object writing to fileobj at the pace of a Throttle"""
+
+    def __init__(self, fileobj: BinaryIO, throttle: Throttle):
+        self.fileobj = fileobj
+        self.throttle = throttle
+
+    def write(self, data):
+        view = memoryview(data)
+        for start in range(0, len(view), RATE_QUANTUM):
+            piece = view[start : start + RATE_QUANTUM]
+            self.throttle.consume(len(piece))
+            self.fileobj.write(piece)
+        return len(view)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    @property
+    def closed(self):
+        return self.fileobj.closed
+
+    def close(self):
+        self.fileobj.close()
+
+
+# Directory archives are compressed on several threads, the way pigz and
+# pbzip2 do: the stream is cut into blocks compressed independently on a
+# thread pool (zlib and bz2 release the GIL while they work), then written
+# out in order. Deflate blocks end with a sync flush and are primed with the
+# end of the previous block, so they join into a single deflate stream
+# compressing about as well as a serial one. Bzip2 blocks are complete
+# streams, which bunzip2 reads one after the other.
+
+COMPRESS_BLOCK_SIZE = {"deflate": 1024 * 1024, "bz2": 900 * 1024, "xz": 4 * 1024 * 1024}
+DEFLATE_WINDOW = 32 * 1024
+ZIP_INLINE_SIZE = 4 * 1024 * 1024
+# Files sent with Content-Encoding are usually compressed while they're sent,
+# where level 9 is several times slower than level 6 for a few percent.
+DEFAULT_LEVELS = {"gz": 9, "bz2": 9, "xz": 6, "zip": 6, "gzip": 6}
+
+
+def compression_level(fmt: str | None = None) -> int:
+    fmt = fmt or compressed
+    if level is None:
+        return DEFAULT_LEVELS[fmt]
+    if fmt == "bz2":
+        return max(level, 1)
+    return level
+
+
+# Compressing data that is already compressed (pictures, videos, archives)
+# costs a lot of CPU for next to no gain, so such data is stored as is. It's
+# recognised by its extension, or by a quick trial compression of a sample
+# at the fastest level, which is a cheap estimate of its entropy.
+
+INCOMPRESSIBLE_EXTENSIONS = {
+    ".7z", ".aac", ".apk", ".avi", ".avif", ".bz2", ".cab", ".deb", ".docx",
+    ".epub", ".flac", ".gif", ".gz", ".heic", ".jar", ".jpeg", ".jpg", ".lz",
+    ".lz4", ".lzma", ".m4a", ".m4v", ".mkv", ".mov", ".mp3", ".mp4", ".mpg",
+    ".odp", ".ods", ".odt", ".ogg", ".opus", ".png", ".pptx", ".rar", ".rpm",
+    ".tbz2", ".tgz", ".txz", ".webm", ".webp", ".whl", ".xlsx", ".xz", ".zip",
+    ".zst",
+}
+COMPRESSIBILITY_SAMPLE_SIZE = 64 * 1024
+
+
+def is_compressible(sample: bytes) -> bool:
+    if len(sample) < 1024:
+        return True
+    return len(zlib.compress(sample, 1)) < len(sample) * 0.95
+
+
+def file_compressible(filename: str) -> bool:
+    if os.path.splitext(filename)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+        return False
+    with open(filename, "rb") as f:
+        return is_compressible(f.read(COMPRESSIBILITY_SAMPLE_SIZE))
+
+
+def imap_ordered(pool, func, iterable, ahead):
+    """Like map(), running func on the pool at most ahead items in advance"""
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(pool.submit(func, item))
+        if len(pending) > ahead:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+class BlockCompressor:
+    """Compressor compressing blocks of data on a thread pool
+
+    It has the compress()/flush() interface of the zlib compressor objects:
+    compress() returns the blocks already compressed, in order.
+    """
+
+    def __init__(self, pool, fmt, level):
+        self.pool = pool
+        self.fmt = fmt
+        self.level = level
+        self.block_size = COMPRESS_BLOCK_SIZE[fmt]
+        self.ahead = 2 * threads
+        self.buffer = bytearray()
+        self.dictionary = b""
+        self.pending = collections.deque()
+
+    def compress_block(self, block, dictionary):
+        if self.fmt == "bz2":
+            import bz2
+
+            return bz2.compress(block, self.level)
+        # Deflate can store incompressible blocks as they are, and xz gets
+        # through them faster at the lowest preset. Bzip2 has no such mode.
+        level = self.level
+        if not is_compressible(block[:COMPRESSIBILITY_SAMPLE_SIZE]):
+            level = 0
+        if self.fmt == "xz":
+            import lzma
+
+            return lzma.compress(block, preset=level)
+        extra = {"zdict": dictionary} if dictionary else {}
+        compressor = zlib.compressobj(
+            level, zlib.DEFLATED, -15, zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, **extra
+        )
+        return compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def submit(self, block):
+        self.pending.append(self.pool.submit(self.compress_block, block, self.dictionary))
+        if self.fmt == "deflate":
+            self.dictionary = block[-DEFLATE_WINDOW:]
+
+    def compress(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self.submit(bytes(self.buffer[: self.block_size]))
+            del self.buffer[: self.block_size]
+
+        output = []
+        while self.pending and (len(self.pending) > self.ahead or self.pending[0].done()):
+            output.append(self.pending.popleft().result())
+        return b"".join(output)
+
+    def flush(self):
+        if self.buffer or (self.fmt != "deflate" and not self.pending):
+            self.submit(bytes(self.buffer))
+            self.buffer.clear()
+        output = [future.result() for future in self.pending]
+        self.pending.clear()
+        if self.fmt == "deflate":
+            # An empty final block ends the deflate stream.
+            output.append(zlib.compressobj(self.level, zlib.DEFLATED, -15).flush())
+        return b"".join(output)
+
+
+class CompressedWriter:
+    """File-like object writing a gzip, bzip2 or xz stream to fileobj"""
+
+    def __init__(self, fileobj, fmt, pool, level):
+        self.fileobj = fileobj
+        self.fmt = fmt
+        self.compressor = BlockCompressor(pool, "deflate" if fmt == "gz" else fmt, level)
+        self.crc = 0
+        self.size = 0
+        if fmt == "gz":
+            # magic, deflate, no flags, no mtime, no extra flags, unknown OS
+            self.fileobj.write(b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff")
+
+    def write(self, data):
+        if self.fmt == "gz":
+            self.crc = zlib.crc32(data, self.crc)
+            self.size += len(data)
+        self.fileobj.write(self.compressor.compress(data))
+        return len(data)
+
+    def close(self):
+        self.fileobj.write(self.compressor.flush())
+        if self.fmt == "gz":
+            self.fileobj.write(struct.pack("<II", self.crc, self.size & 0xFFFFFFFF))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if exc_info[0] is None:
+            self.close()
+
+
+class PrecompressedData:
+    """Stand-in for a zipfile compressor, giving back data compressed beforehand"""
+
+    def __init__(self, data):
+        self.data = data
+
+    def compress(self, data):
+        return b""
+
+    def flush(self):
+        return self.data
+
+
+# Archives are fed by a pipeline: the tree is enumerated with os.scandir, in
+# the order tarfile.add() uses (sorted names, each directory followed by its
+# contents), while a small pool of threads opens the upcoming files and reads
+# the small ones ahead, a batch of entries at a time. On a cold cache or a
+# network filesystem, where every open and read waits on the disk or the
+# server, these waits overlap with writing the archive instead of adding up.
+# Large files are only hinted to the kernel, which reads them ahead in the
+# background, so that little is buffered and few files are open at once.
+
+WALK_THREADS = 8
+WALK_BATCH = 64
+TAR_INLINE_SIZE = 64 * 1024
+READ_AHEAD_SIZE = 8 * 1024 * 1024
+
+
+def walk_tree(dirname: str, arcname: str, entry=None) -> Generator:
+    """Yield (path, arcname, entry) for dirname and everything under it
+
+    entry is the os.DirEntry of path, None for dirname itself.
+    """
+    yield dirname, arcname, entry
+    with os.scandir(dirname) as it:
+        entries = sorted(it, key=lambda entry: entry.name)
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield from walk_tree(entry.path, arcname + "/" + entry.name, entry)
+        else:
+            yield entry.path, arcname + "/" + entry.name, entry
+
+
+def batched(iterable, n: int) -> Generator:
+    """Yield lists of n items of iterable, the last one maybe shorter"""
+    iterator = iter(iterable)
+    for batch in iter(lambda: list(itertools.islice(iterator, n)), []):
+        yield batch
+
+
+def open_ahead(path: str) -> BinaryIO:
+    """Open path for reading, asking the kernel to read it ahead"""
+    f = open(path, "rb")
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(f.fileno(), 0, READ_AHEAD_SIZE, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+    return f
+
+
+def prefetch(items: list) -> list:
+    """Read ahead the regular files of a batch of walk_tree() items
+
+    Returns (path, arcname, entry, data) tuples, data being the contents of
+    small files and None for everything else.
+    """
+    result = []
+    for path, arcname, entry in items:
+        data = None
+        if entry is not None and entry.is_file(follow_symlinks=False):
+            with open_ahead(path) as src:
+                if os.fstat(src.fileno()).st_size <= TAR_INLINE_SIZE:
+                    data = src.read()
+        result.append((path, arcname, entry, data))
+    return result
+
+
+def write_tar(dirname: str, fileobj: BinaryIO):
+    """Write a tar archive of the dirname directory to fileobj"""
+    import io, tarfile
+
+    batches = batched(walk_tree(dirname, os.path.basename(dirname)), WALK_BATCH)
+    with concurrent.futures.ThreadPoolExecutor(WALK_THREADS) as io_pool:
+        with tarfile.open(mode="w|", fileobj=fileobj) as tfile:
+            for batch in imap_ordered(io_pool, prefetch, batches, WALK_THREADS):
+                for path, arcname, entry, data in batch:
+                    tarinfo = tfile.gettarinfo(path, arcname)
+                    if tarinfo is None:
+                        continue
+                    if not tarinfo.isreg():
+                        tfile.addfile(tarinfo)
+                    elif data is not None:
+                        tarinfo.size = len(data)
+                        tfile.addfile(tarinfo, io.BytesIO(data))
+                    else:
+                        with open_ahead(path) as src:
+                            tfile.addfile(tarinfo, src)
+
+
+def write_zip(dirname: str, fileobj: BinaryIO, pool):
+    # Small files are read and compressed ahead on the pool, several at a
+    # time; large ones are compressed block by block as they're written.
+    # Either way, the compressed data goes through the compressor of the
+    # zipfile member, which then only has to compute the CRC. That
+    # compressor is private to zipfile: where it's missing, zipfile
+    # compresses the files itself.
+    import zipfile
+
+    def entries():
+        # Zip archives only hold files: directories are implied, and special
+        # files and dangling symbolic links are left out.
+        for path, arcname, entry in walk_tree(dirname, os.path.basename(dirname)):
+            if entry is not None and entry.is_file():
+                yield path, arcname
+
+    zlevel = compression_level()
+
+    def load(item):
+        filename, arcname = item
+        zinfo = zipfile.ZipInfo.from_file(filename, arcname)
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        if os.path.splitext(filename)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+            zinfo.compress_type = zipfile.ZIP_STORED
+        if zinfo.file_size > ZIP_INLINE_SIZE:
+            # Left open for the writer, the kernel reading it ahead meanwhile.
+            data = None
+            src = open_ahead(filename)
+            if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+                sample = src.read(COMPRESSIBILITY_SAMPLE_SIZE)
+                src.seek(0)
+        else:
+            src = None
+            with open(filename, "rb") as f:
+                data = sample = f.read()
+        if zinfo.compress_type == zipfile.ZIP_DEFLATED and not is_compressible(
+            sample[:COMPRESSIBILITY_SAMPLE_SIZE]
+        ):
+            zinfo.compress_type = zipfile.ZIP_STORED
+        if data is None or zinfo.compress_type == zipfile.ZIP_STORED:
+            return zinfo, src, data, None
+        compressor = zlib.compressobj(zlevel, zlib.DEFLATED, -15)
+        return zinfo, src, data, compressor.compress(data) + compressor.flush()
+
+    with zipfile.ZipFile(fileobj, "w", zipfile.ZIP_DEFLATED) as zfile:
+        ahead = 2 * threads
+        for zinfo, src, data, packed in imap_ordered(pool, load, entries(), ahead):
+            with zfile.open(zinfo, "w") as dest:
+                compressor = None
+                if packed is not None:
+                    compressor = PrecompressedData(packed)
+                elif zinfo.compress_type == zipfile.ZIP_DEFLATED:
+                    compressor = BlockCompressor(pool, "deflate", zlevel)
+                if compressor is not None and hasattr(dest, "_compressor"):
+                    dest._compressor = compressor
+
+                if data is not None:
+                    dest.write(data)
+                else:
+                    with src:
+                        shutil.copyfileobj(src, dest, COPY_BUFFER_SIZE)
+
+
+def write_gzip(filename: str, fileobj: BinaryIO):
+    """Write a gzip compressed copy of the filename file to fileobj"""
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        with open(filename, "rb") as src:
+            with CompressedWriter(fileobj, "gz", pool, compression_level("gzip")) as output:
+                shutil.copyfileobj(src, output, COPY_BUFFER_SIZE)
+
+
+def write_archive(dirname: str, fileobj: BinaryIO):
+    """Write an archive of the dirname directory to fileobj"""
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        if compressed == "zip":
+            write_zip(dirname, fileobj, pool)
+        elif compressed:
+            with CompressedWriter(fileobj, compressed, pool, compression_level()) as output:
+                write_tar(dirname, output)
+        else:
+            write_tar(dirname, fileobj)
+
+
+# An uncompressed tar archive is a header for every entry, each followed by
+# the contents of the file padded to a block, and two empty blocks padded
+# to a record at the end. Its layout thus follows from the metadata of the
+# tree alone: a scan of the tree gives the headers and the offset of every
+# file in the archive, hence the exact size of the archive, sent as
+# Content-Length, and the parts of the archive making up any range of it.
+# The archive is sent straight from the files, never built. A file changing
+# size in the meantime is cut or padded with zeros to the size given in its
+# header, as GNU tar does, so that the archive always matches its layout.
+
+TAR_BLOCK_SIZE = 512
+TAR_RECORD_SIZE = 20 * TAR_BLOCK_SIZE
+
+
+class TarLayout:
+    """Layout of the uncompressed tar archive of a directory
+
+    It stands in for the stat result of the archive: st_size is the size
+    of the archive, st_mtime and st_mtime_ns the latest modification time
+    in the tree. The ETag is a hash of all the headers.
+    """
+
+    def __init__(self, dirname: str):
+        import io, tarfile
+
+        # The headers are the ones tarfile writes, hard links included.
+        tfile = tarfile.TarFile(fileobj=io.BytesIO(), mode="w")
+        self.offsets = []
+        self.members = []
+        digest = hashlib.sha1()
+        offset = 0
+        self.st_mtime = 0
+        for path, arcname, _ in walk_tree(dirname, os.path.basename(dirname)):
+            tarinfo = tfile.gettarinfo(path, arcname)
+            if tarinfo is None:
+                continue
+            header = tarinfo.tobuf(tfile.format, tfile.encoding, tfile.errors)
+            digest.update(header)
+            self.offsets.append(offset)
+            self.members.append((header, path, tarinfo.size))
+            offset += len(header) + tarinfo.size + -tarinfo.size % TAR_BLOCK_SIZE
+            self.st_mtime = max(self.st_mtime, tarinfo.mtime)
+        self.end = offset
+        self.st_size = offset + 2 * TAR_BLOCK_SIZE
+        self.st_size += -self.st_size % TAR_RECORD_SIZE
+        self.st_mtime_ns = int(self.st_mtime * 1e9)
+        self.etag = '"%s"' % digest.hexdigest()
+
+    def parts(self, first: int, last: int) -> Generator:
+        """Yield the parts of the archive from offset first to last included
+
+        Headers and padding are given as bytes, file contents as (path,
+        offset, count) tuples.
+        """
+        import bisect
+
+        end = last + 1
+        index = max(bisect.bisect_right(self.offsets, first) - 1, 0)
+        for offset, (header, path, size) in zip(
+            itertools.islice(self.offsets, index, None),
+            itertools.islice(self.members, index, None),
+        ):
+            if offset >= end:
+                return
+            padding = -size % TAR_BLOCK_SIZE
+            for part, length in ((header, len(header)), (path, size), (None, padding)):
+                start, stop = max(first, offset), min(end, offset + length)
+                if start < stop:
+                    if part is None:
+                        yield bytes(stop - start)
+                    elif isinstance(part, bytes):
+                        yield part[start - offset : stop - offset]
+                    else:
+                        yield part, start - offset, stop - start
+                offset += length
+        start = max(first, self.end)
+        if start < end:
+            yield bytes(end - start)
+
+
+def read_member(path: str, offset: int, count: int) -> bytes:
+    """Read count bytes of path from offset, padded with zeros if it's shorter"""
+    try:
+        with open(path, "rb") as src:
+            src.seek(offset)
+            data = src.read(count)
+    except OSError:
+        data = b""
+    if len(data) < count:
+        print("%s got shorter while being sent" % path, file=sys.stderr)
+        data += bytes(count - len(data))
+    return data
+
+
+def send_tar(
+    layout: TarLayout, sock: socket.socket, first=0, count=None, throttle=None
+) -> int:
+    """Send count bytes of the archive of layout, starting at first, to sock
+
+    Small files are read ahead on a pool of threads and sent together with
+    the headers; large ones are sent with send_file(). Returns the number
+    of bytes sent.
+    """
+    if count is None:
+        count = layout.st_size - first
+    buffer = bytearray()
+    total_sent = 0
+
+    def load(parts):
+        return [
+            read_member(*part)
+            if isinstance(part, tuple) and part[2] <= TAR_INLINE_SIZE
+            else part
+            for part in parts
+        ]
+
+    def flush():
+        nonlocal total_sent
+        if throttle is not None:
+            throttle.consume(len(buffer))
+        sock.sendall(buffer)
+        total_sent += len(buffer)
+        buffer.clear()
+
+    batches = batched(layout.parts(first, first + count - 1), WALK_BATCH)
+    with concurrent.futures.ThreadPoolExecutor(WALK_THREADS) as io_pool:
+        for batch in imap_ordered(io_pool, load, batches, WALK_THREADS):
+            for part in batch:
+                if isinstance(part, bytes):
+                    buffer += part
+                    if len(buffer) >= COPY_BUFFER_SIZE:
+                        flush()
+                    continue
+                flush()
+                path, offset, size = part
+                try:
+                    src = open_ahead(path)
+                except OSError:
+                    sent = 0
+                else:
+                    with src:
+                        sent = send_file(src, sock, offset, size, throttle)
+                    total_sent += sent
+                if sent < size:
+                    print("%s got shorter while being sent" % path, file=sys.stderr)
+                    buffer += bytes(size - sent)
+    flush()
+    return total_sent
+
+
+# Directory archives are built once and kept in a cache, so serving a
+# directory to several clients doesn't walk and compress it every time.
+# A cached archive is keyed by a signature of the tree, made of the name,
+# size and mtime of every entry: any change to the directory invalidates it.
+# The gzip copy of a single file sent with Content-Encoding is cached the
+# same way, keyed by the size and mtime of the file.
+# Only one build of an archive runs at a time: the clients asking for it
+# while it's being built follow the build, reading the archive from the
+# cache file as it grows, rather than building it again.
+
+
+class ArchiveBuild:
+    """An archive being written to a cache file, for others to follow"""
+
+    def __init__(self, tmpname: str):
+        self.tmpname = tmpname
+        self.condition = threading.Condition()
+        self.size = 0
+        self.done = False
+        self.failed = False
+
+    def grow(self, size: int):
+        with self.condition:
+            self.size += size
+            self.condition.notify_all()
+
+    def finish(self, failed=False):
+        with self.condition:
+            self.done = True
+            self.failed = failed
+            self.condition.notify_all()
+
+    def follow(self, src: BinaryIO, client: BinaryIO):
+        """Copy the archive from src, the cache file, to client as it grows"""
+        offset = 0
+        while True:
+            with self.condition:
+                while self.size == offset and not self.done:
+                    self.condition.wait()
+                size, done, failed = self.size, self.done, self.failed
+            if failed:
+                raise OSError("building the archive failed")
+            while offset < size:
+                data = src.read(min(COPY_BUFFER_SIZE, size - offset))
+                if not data:
+                    raise OSError("the archive got shorter while being sent")
+                client.write(data)
+                offset += len(data)
+            if done:
+                return
+
+
+class TeeWriter:
+    """File-like object writing both to a client and to a cache file
+
+    If the client goes away, the archive is still written to the cache.
+    """
+
+    def __init__(self, client: BinaryIO | None, cachefile: BinaryIO, build: ArchiveBuild):
+        self.client = client
+        self.cachefile = cachefile
+        self.build = build
+        self.client_error = None
+
+    def write(self, data):
+        if self.client is not None:
+            try:
+                self.client.write(data)
+            except OSError as ex:
+                self.client = None
+                self.client_error = ex
+        written = self.cachefile.write(data)
+        # The followers of the build read what's flushed.
+        self.cachefile.flush()
+        self.build.grow(len(data))
+        return written
+
+    def flush(self):
+        if self.client is not None:
+            self.client.flush()
+        self.cachefile.flush()
+
+
+class ArchiveCache:
+    def __init__(self, path: str, archive_ext: str):
+        import tempfile
+
+        self.path = path
+        self.archive_ext = archive_ext
+        self.directory = tempfile.mkdtemp(prefix="wurf-")
+        self.owner = os.getpid()
+        self.lock = threading.Lock()
+        self.builds = {}
+        atexit.register(self.cleanup)
+
+    def cleanup(self):
+        # Forked children run the exit handlers too.
+        if os.getpid() == self.owner:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def signature(self) -> str:
+        digest = hashlib.sha1()
+        if not os.path.isdir(self.path):
+            st = os.stat(self.path)
+            digest.update(b"%d\0%d\0" % (st.st_size, st.st_mtime_ns))
+        for root, dirs, files in os.walk(self.path):
+            dirs.sort()
+            for path in [root] + [os.path.join(root, f) for f in sorted(files)]:
+                st = os.lstat(path)
+                digest.update(
+                    b"%b\0%d\0%d\0"
+                    % (os.fsencode(path), st.st_size, st.st_mtime_ns)
+                )
+        return digest.hexdigest()
+
+    def open(self, signature: str) -> BinaryIO | None:
+        """Open the cached archive for signature, if there is one"""
+        try:
+            return open(os.path.join(self.directory, signature + self.archive_ext), "rb")
+        except FileNotFoundError:
+            return None
+
+    def build(self, signature: str, client: BinaryIO | None = None):
+        """Build the archive into the cache, streaming it to client too
+
+        If the archive is being built already, the client follows that
+        build instead. Returns True if the archive was built, and raises
+        the error of the client if it went away, once the archive is in
+        the cache.
+        """
+        import tempfile
+
+        src = None
+        with self.lock:
+            build = self.builds.get(signature)
+            if build is not None:
+                # Opened while the build runs, before its file is renamed.
+                src = open(build.tmpname, "rb")
+            else:
+                fd, tmpname = tempfile.mkstemp(prefix=".build-", dir=self.directory)
+                build = self.builds[signature] = ArchiveBuild(tmpname)
+        if src is not None:
+            with src:
+                if client is not None:
+                    build.follow(src, client)
+            return False
+
+        try:
+            with open(fd, "wb") as cachefile:
+                output = TeeWriter(client, cachefile, build)
+                if os.path.isdir(self.path):
+                    write_archive(self.path, output)
+                else:
+                    write_gzip(self.path, output)
+                output.flush()
+
+            # Don't keep an archive of a tree modified while we read it.
+            keep = self.signature() == signature
+            with self.lock:
+                del self.builds[signature]
+                if keep:
+                    path = os.path.join(self.directory, signature + self.archive_ext)
+                    os.replace(tmpname, path)
+                    self.prune(keep=path)
+                else:
+                    os.unlink(tmpname)
+            build.finish()
+        except BaseException:
+            with self.lock:
+                self.builds.pop(signature, None)
+            build.finish(failed=True)
+            with contextlib.suppress(OSError):
+                os.unlink(tmpname)
+            raise
+        if output.client_error:
+            raise output.client_error
+        return True
+
+    def prune(self, keep: str):
+        # Archives of previous states of the tree are useless now. Those
+        # still being sent can go too, their reader keeps them open.
+        for entry in os.scandir(self.directory):
+            if entry.path != keep and not entry.name.startswith(".build-"):
+                with contextlib.suppress(OSError):
+                    os.unlink(entry.path)
+
+
+# In browse mode, the directory is served as a tree of listings rather than
+# as a single archive. The listings come from an index of the tree built
+# with os.scandir when the server starts. A directory is scanned again when
+# its mtime changes, which it does whenever an entry is added, removed or
+# renamed in it.
+
+
+class TreeIndex:
+    def __init__(self, root: str):
+        self.root = root
+        self.realroot = os.path.realpath(root)
+        self.lock = threading.Lock()
+        self.dirs = {}
+
+        # Symlinked directories are only scanned when they're browsed, so
+        # a link loop doesn't send the walk around in circles.
+        pending = [""]
+        while pending:
+            relpath = pending.pop()
+            for name, is_dir, _, _ in self.scan(relpath) or []:
+                subdir = os.path.join(relpath, name)
+                if is_dir and not os.path.islink(os.path.join(root, subdir)):
+                    pending.append(subdir)
+
+    def scan(self, relpath: str) -> list[tuple[str, bool, int, float]] | None:
+        """Scan the relpath directory, returns its sorted entries"""
+        path = os.path.join(self.root, relpath)
+        try:
+            # Taken first, so a change during the scan triggers another.
+            mtime = os.stat(path).st_mtime_ns
+            entries = []
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_symlink() and not self.contains(entry.path):
+                        continue
+                    try:
+                        is_dir = entry.is_dir()
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    size = 0 if is_dir else st.st_size
+                    entries.append((entry.name, is_dir, size, st.st_mtime))
+        except OSError:
+            return None
+        entries.sort(key=lambda entry: (not entry[1], entry[0]))
+        with self.lock:
+            self.dirs[relpath] = (mtime, entries)
+        return entries
+
+    def contains(self, path: str) -> bool:
+        """Whether path, once symlinks are resolved, is inside the tree"""
+        real = os.path.realpath(path)
+        return real == self.realroot or real.startswith(self.realroot + os.sep)
+
+    def listing(self, relpath: str) -> list[tuple[str, bool, int, float]] | None:
+        """Entries of the relpath directory, scanned again if it changed"""
+        try:
+            mtime = os.stat(os.path.join(self.root, relpath)).st_mtime_ns
+        except OSError:
+            return None
+        with self.lock:
+            cached = self.dirs.get(relpath)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        return self.scan(relpath)
+
+    def totals(self) -> tuple[int, int]:
+        """Number of directories and files in the index"""
+        with self.lock:
+            files = sum(
+                not entry[1] for _, entries in self.dirs.values() for entry in entries
+            )
+            return len(self.dirs), files
+
+
+def upload_filename(name: str) -> str:
+    """The name to store an upload under, without any directory"""
+    if "\\" in name:
+        name = name.rsplit("\\", 1)[-1]
+    return os.path.basename(name)
+
+
+def create_upload_file(upfilename: str) -> tuple[int, str]:
+    """Create a new file for an upload, returns its descriptor and name
+
+    An existing file is never overwritten, a suffix is appended instead.
+    """
+    destfile = None
+    for suffix in ["", ".1", ".2", ".3", ".4", ".5", ".6", ".7", ".8", ".9"]:
+        destfilename = os.path.join(".", upfilename + suffix)
+        try:
+            destfile = os.open(
+                destfilename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644
+            )
+            break
+        except OSError as ex:
+            if ex.errno == errno.EEXIST:
+                continue
+            raise
+
+    if not destfile:
+        import tempfile
+
+        destfile, destfilename = tempfile.mkstemp(prefix=upfilename + ".", dir=".")
+    return destfile, destfilename
+
+
+# Large uploads can be sent in pieces, each one a PUT (or raw POST) with a
+# Content-Range header, in any order and over several connections at once.
+# The pieces are written at their offset in a hidden part file, and the
+# ranges received so far are kept next to it, so that an interrupted upload
+# can be resumed, even after a restart of the server. A piece with the range
+# "*" only asks for the ranges received. Once the whole file is there, the
+# part file takes the name of the upload. Uploads are told apart by name and
+# size, and by the Repr-Digest of the whole file when the client gives it,
+# so that two files of the same name and size don't get mixed up.
+
+
+class PartialUpload:
+    def __init__(self, name: str, size: int, digest: bytes | None = None):
+        self.name = name
+        self.size = size
+        self.lock = threading.Lock()
+        self.done = False
+        key = b"%b\0%d" % (os.fsencode(name), size)
+        if digest is not None:
+            key += b"\0" + digest
+        key = hashlib.sha1(key).hexdigest()[:16]
+        self.partname = os.path.join(".", ".wurf-upload-" + key)
+        self.rangesname = self.partname + ".ranges"
+        self.load()
+        os.close(os.open(self.partname, os.O_WRONLY | os.O_CREAT, 0o644))
+
+    def load(self):
+        try:
+            with open(self.rangesname) as f:
+                self.received = [tuple(r) for r in json.load(f)["received"]]
+        except (OSError, ValueError, KeyError):
+            self.received = []
+
+    @contextlib.contextmanager
+    def workers_lock(self):
+        """Hold the ranges against the other workers, if any
+
+        Pieces of an upload may reach several workers: the ranges file
+        is the one they all add to, so it's read again under the lock.
+        """
+        if workers <= 1:
+            yield
+            return
+        import fcntl
+
+        try:
+            fd = os.open(self.partname, os.O_RDONLY)
+        except FileNotFoundError:
+            # Another worker received the last piece.
+            self.load()
+            yield
+            return
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            self.load()
+            yield
+        finally:
+            os.close(fd)
+
+    def add(self, first: int, last: int):
+        """Record the first to last bytes as received"""
+        with self.lock, self.workers_lock():
+            merged = []
+            for r in sorted(self.received + [(first, last)]):
+                if merged and r[0] <= merged[-1][1] + 1:
+                    merged[-1] = (merged[-1][0], max(merged[-1][1], r[1]))
+                else:
+                    merged.append(r)
+            self.received = merged
+            tmpname = "%s.tmp-%d-%d" % (self.rangesname, os.getpid(), threading.get_ident())
+            with open(tmpname, "w") as f:
+                json.dump({"name": self.name, "size": self.size, "received": merged}, f)
+            os.replace(tmpname, self.rangesname)
+
+    def range_headers(self) -> list[tuple[str, str]]:
+        """The Range header listing the bytes received, if any"""
+        with self.lock, self.workers_lock():
+            if not self.received:
+                return []
+            return [("Range", "bytes=" + ",".join("%d-%d" % r for r in self.received))]
+
+    def received_size(self) -> int:
+        with self.lock, self.workers_lock():
+            return sum(last - first + 1 for first, last in self.received)
+
+    def finish(self) -> bool:
+        """Returns True once, when all the bytes of the file are received"""
+        with self.lock:
+            if self.done or self.received != [(0, self.size - 1)]:
+                return False
+            self.done = True
+            return True
+
+    def remove(self):
+        with contextlib.suppress(OSError):
+            os.unlink(self.rangesname)
+
+
+# Downloads are accounted for in a DownloadCounter shared by all the
+# request handler threads. A transfer that counts reserves one of the
+# downloads left while it runs, and only uses it up when it completes: a
+# broken transfer gives it back, so that the client can try again.
+
+
+class DownloadCounter:
+    def __init__(self, count: int):
+        self.lock = threading.Lock()
+        self.left = count
+        self.reserved = 0
+        self.active = 0
+
+    def begin(self, counts=True) -> bool:
+        """Register a new transfer, returns False if none is left"""
+        with self.lock:
+            if counts:
+                if self.reserved >= self.left:
+                    return False
+                self.reserved += 1
+            self.active += 1
+            return True
+
+    def end(self, counts=True, completed=True):
+        with self.lock:
+            if counts:
+                self.reserved -= 1
+                if completed:
+                    self.left -= 1
+            self.active -= 1
+
+    def complete(self):
+        """Count a transfer that completed without a reservation"""
+        with self.lock:
+            self.left -= 1
+
+    def finished(self) -> bool:
+        with self.lock:
+            return self.left <= 0 and self.active == 0
+
+
+# The server keeps counters and histograms of what it does, served in the
+# Prometheus text format on METRICS_PATH and summed up at exit. Histograms
+# have cumulative buckets, like Prometheus wants them.
+
+METRICS_PATH = "/_wurf/metrics"
+SECONDS_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1, 2.5, 5, 10, 30, 60, 300, 1800,
+)
+THROUGHPUT_BUCKETS = (1e4, 1e5, 1e6, 1e7, 1e8, 1e9, 1e10)
+METRICS = {
+    "wurf_requests_total": ("counter", "Requests answered, by status code", None),
+    "wurf_sent_bytes_total": ("counter", "Bytes of downloads sent", None),
+    "wurf_received_bytes_total": ("counter", "Bytes of uploads received", None),
+    "wurf_transfers_total": ("counter", "Transfers completed, by direction", None),
+    "wurf_errors_total": ("counter", "Errors, by kind", None),
+    "wurf_active_transfers": ("gauge", "Downloads and uploads in progress", None),
+    "wurf_downloads_left": ("gauge", "Downloads left before exiting", None),
+    "wurf_transfer_duration_seconds": (
+        "histogram", "Duration of the transfers, by direction", SECONDS_BUCKETS
+    ),
+    "wurf_transfer_throughput_bytes_per_second": (
+        "histogram", "Throughput of the transfers, by direction", THROUGHPUT_BUCKETS
+    ),
+    "wurf_time_to_first_byte_seconds": (
+        "histogram", "Time from a download request to its response", SECONDS_BUCKETS
+    ),
+    "wurf_tls_handshake_seconds": (
+        "histogram", "Duration of the TLS handshakes", SECONDS_BUCKETS
+    ),
+    "wurf_archive_build_seconds": (
+        "histogram", "Time taken to build an archive or a gzip copy", SECONDS_BUCKETS
+    ),
+}
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {
+            ("wurf_sent_bytes_total", ()): 0,
+            ("wurf_received_bytes_total", ()): 0,
+        }
+        # Bumped on every update, to tell whether they're worth publishing.
+        self.changes = 0
+
+    def add(self, name: str, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+            self.changes += 1
+
+    def observe(self, name: str, value: float, **labels):
+        buckets = METRICS[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * len(buckets), 0.0, 0]
+            histogram = self.values[key]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+            self.changes += 1
+
+    def merge(self, values: dict):
+        """Add the values of another Metrics to these"""
+        with self.lock:
+            for key, value in values.items():
+                if not isinstance(value, list):
+                    self.values[key] = self.values.get(key, 0) + value
+                    continue
+                if key not in self.values:
+                    self.values[key] = [[0] * len(value[0]), 0.0, 0]
+                histogram = self.values[key]
+                histogram[0] = [a + b for a, b in zip(histogram[0], value[0])]
+                histogram[1] += value[1]
+                histogram[2] += value[2]
+
+    def total(self, name: str, **labels):
+        """Sum of a counter, or (sum, count) of a histogram, over its labels"""
+        total = (0.0, 0) if METRICS[name][2] else 0
+        with self.lock:
+            for (key_name, key_labels), value in self.values.items():
+                if key_name != name or not labels.items() <= set(key_labels):
+                    continue
+                if isinstance(value, list):
+                    total = (total[0] + value[1], total[1] + value[2])
+                else:
+                    total += value
+        return total
+
+    def render(self, gauges: dict) -> str:
+        """Returns the metrics in the Prometheus text format"""
+        with self.lock:
+            values = [
+                (key, [list(value[0])] + value[1:] if isinstance(value, list) else value)
+                for key, value in self.values.items()
+            ]
+        values += [((name, ()), value) for name, value in gauges.items()]
+        values.sort()
+
+        lines = []
+        for name, (kind, description, buckets) in METRICS.items():
+            lines.append("# HELP %s %s." % (name, description))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for (key_name, labels), value in values:
+                if key_name != name:
+                    continue
+                if kind != "histogram":
+                    lines.append("%s%s %s" % (name, format_labels(labels), value))
+                    continue
+                counts, total, count = value
+                for bound, bucket_count in zip(buckets, counts):
+                    lines.append(
+                        "%s_bucket%s %d"
+                        % (name, format_labels(labels + (("le", "%g" % bound),)), bucket_count)
+                    )
+                lines.append(
+                    "%s_bucket%s %d" % (name, format_labels(labels + (("le", "+Inf"),)), count)
+                )
+                lines.append("%s_sum%s %r" % (name, format_labels(labels), total))
+                lines.append("%s_count%s %d" % (name, format_labels(labels), count))
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in labels
+    )
+
+
+# With --trace, every request gets a JSON line in the trace file, with the
+# time spent in each phase of serving it: waiting for a thread and the TLS
+# handshake for the first request of a connection, reading the request,
+# then sending the headers and the body. For archives and gzip copies
+# built on the fly, the time spent blocked on socket writes is told apart
+# from the time spent walking, reading and compressing. Without --trace,
+# phases is None and nothing is measured.
+
+
+class Tracer:
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.file = open(path, "a")
+
+    def write(self, record: dict):
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+
+@contextlib.contextmanager
+def timed_phase(phases: dict | None, name: str):
+    """Add the time spent in the with block to phases[name]"""
+    if phases is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases[name] = phases.get(name, 0.0) + time.perf_counter() - start
+
+
+class TimedWriter:
+    """File-like object adding the time spent writing to phases[name]"""
+
+    def __init__(self, fileobj: BinaryIO, phases: dict, name: str):
+        self.fileobj = fileobj
+        self.phases = phases
+        self.name = name
+
+    def write(self, data):
+        with timed_phase(self.phases, self.name):
+            return self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+# With TLS, the handshake runs on the thread serving the connection, not
+# in the accept loop: a slow or stalled client only holds up itself, for at
+# most HANDSHAKE_TIMEOUT seconds. The context is shared by all connections,
+# so that returning clients can resume their session from a ticket or the
+# session cache instead of doing a full handshake.
+
+HANDSHAKE_TIMEOUT = 10
+TLS_CIPHERS = "ECDHE+AESGCM:ECDHE+CHACHA20"
+
+
+def tls_context(cert, key, keypass) -> ssl.SSLContext:
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    # TLS 1.3 only has ephemeral key exchanges and AEAD ciphers; this
+    # restricts TLS 1.2 to the same.
+    context.set_ciphers(TLS_CIPHERS)
+    context.options |= ssl.OP_CIPHER_SERVER_PREFERENCE | ssl.OP_SINGLE_ECDH_USE
+    context.options &= ~ssl.OP_NO_TICKET
+    # Only Python 3.8 and later can set the number of TLS 1.3 tickets.
+    if hasattr(context, "num_tickets"):
+        context.num_tickets = 2
+    context.load_cert_chain(cert, key, keypass)
+    return context
+
+
+# With --workers, the server runs in several processes, so that accepting
+# connections, TLS handshakes and parsing requests and uploads use several
+# cores rather than one. The parent binds the listening socket and forks
+# the workers, each serving connections on a thread pool of its own. Where
+# the system has SO_REUSEPORT, every worker but the first listens on a
+# socket of its own bound to the same address, and the kernel spreads the
+# connections between them; otherwise they all accept on the socket of the
+# parent. The count of downloads left and the --rate bucket live in memory
+# shared by the workers, so that they hold for all of them together. The
+# workers exit once the count is used up, handing their metrics over to
+# the parent for the summary.
+# Meanwhile, every worker writes its metrics to a file of its own in a
+# directory made by the parent, at most every METRICS_PUBLISH_INTERVAL
+# seconds, and the one answering /_wurf/metrics adds up all the files
+# after writing its own. The files only ever grow and the ones of the
+# workers gone stay, so the counters never go back between two scrapes.
+
+METRICS_PUBLISH_INTERVAL = 0.5
+
+
+class SharedValue:
+    """Attribute kept in the shared array of its object, at index"""
+
+    def __init__(self, index: int):
+        self.index = index
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        return obj.shared[self.index]
+
+    def __set__(self, obj, value):
+        obj.shared[self.index] = value
+
+
+class SharedDownloadCounter(DownloadCounter):
+    """DownloadCounter shared with the processes forked afterwards"""
+
+    left = SharedValue(0)
+    reserved = SharedValue(1)
+    active = SharedValue(2)
+
+    def __init__(self, count: int):
+        import multiprocessing
 
-    content = b"Content-Type: %b\r\n%b" % (content_type, data)
+        self.shared = multiprocessing.RawArray("q", 3)
+        super().__init__(count)
+        self.lock = multiprocessing.Lock()
 
-    parsed = email.parser.BytesParser().parsebytes(content)
 
-    results = []
-    for part in parsed.get_payload():
-        params = part.get_params(header="content-disposition")
-        payload: bytes = part.get_payload(decode=True)
-        result = dict(params), payload
-        results.append(result)
-    return results
+class SharedTokenBucket(TokenBucket):
+    """TokenBucket shared with the processes forked afterwards"""
 
+    tokens = SharedValue(0)
+    stamp = SharedValue(1)
 
-# our own HTTP server class, fixing up a change in python 2.7
-# since we do our fork() in the request handler
-# the server must not shutdown() the socket.
+    def __init__(self, rate: int):
+        import multiprocessing
 
+        self.shared = multiprocessing.RawArray("d", 2)
+        super().__init__(rate)
+        self.lock = multiprocessing.Lock()
+
+
+# Our own HTTP server class, handling each connection on a thread of a
+# bounded pool: at most maxtransfers clients are served at once, the next
+# ones wait in the listen queue. The accept loop wakes up every timeout
+# seconds to notice when the last download is over.
+# Connections are kept open between requests, so that the redirect and the
+# download share one connection. A kept-alive connection is closed after
+# KEEPALIVE_TIMEOUT idle seconds, and any connection where the client
+# neither sends nor reads anything for TRANSFER_TIMEOUT seconds.
+
+KEEPALIVE_TIMEOUT = 15
+TRANSFER_TIMEOUT = 60
+
+
+class ThreadPoolHTTPServer(http.server.HTTPServer):
+    timeout = 0.5
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class, maxdown, maxtransfers, workers=1):
+        # Set by hand: socketserver only has allow_reuse_port since 3.11.
+        self.reuse_port = workers > 1 and hasattr(socket, "SO_REUSEPORT")
+        super().__init__(server_address, handler_class)
+        if workers > 1:
+            self.downloads = SharedDownloadCounter(maxdown)
+        else:
+            self.downloads = DownloadCounter(maxdown)
+        self.slots = threading.BoundedSemaphore(maxtransfers)
+        self.pool = concurrent.futures.ThreadPoolExecutor(maxtransfers)
+        self.idle_lock = threading.Lock()
+        self.idle = set()
+        self.closing = False
+        self.ssl_context = None
+        self.digests = DigestCache()
+        self.manifests = ManifestCache()
+        self.swarm = None
+        self.metrics = Metrics()
+        self.metrics_dir = None
+        self.metrics_file = None
+        self.metrics_published = (0, 0.0)
+        self.connection_phases = threading.local()
+        self.request_ids = itertools.count(1)
+        self.uploads_lock = threading.Lock()
+        self.uploads = {}
+        self.stats_lock = threading.Lock()
+        self.handshakes = 0
+        self.handshakes_resumed = 0
+        self.handshakes_failed = 0
+        self.handshake_time = 0.0
+        self.handshake_time_max = 0.0
+        self.rate_bucket = None
+        if rate and workers > 1:
+            self.rate_bucket = SharedTokenBucket(rate)
+        elif rate:
+            self.rate_bucket = TokenBucket(rate)
+        self.client_buckets_lock = threading.Lock()
+        self.client_buckets = {}
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def listen(self):
+        """Bind a socket of our own to the address of the server"""
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.socket.bind(self.server_address)
+        self.server_activate()
 
-class ForkingHTTPServer(http.server.HTTPServer):
     def process_request(self, request, client_address):
-        self.finish_request(request, client_address)
-        self.close_request(request)
+        accepted = time.perf_counter()
+        self.slots.acquire()
+        self.pool.submit(self.process_request_thread, request, client_address, accepted)
+
+    def process_request_thread(self, request, client_address, accepted):
+        # The handler gets these with the phases of its first request.
+        phases = None
+        if tracer is not None:
+            phases = {"queue": time.perf_counter() - accepted}
+        self.connection_phases.phases = phases
+        try:
+            if self.ssl_context is not None:
+                request = self.ssl_context.wrap_socket(
+                    request, server_side=True, do_handshake_on_connect=False
+                )
+                with timed_phase(phases, "tls_handshake"):
+                    if not self.tls_handshake(request, client_address):
+                        return
+            self.finish_request(request, client_address)
+        except Exception:
+            self.metrics.add("wurf_errors_total", kind="internal")
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def tls_handshake(self, connection, client_address):
+        """Run the TLS handshake of a new connection, returns True on success"""
+        start = time.monotonic()
+        connection.settimeout(HANDSHAKE_TIMEOUT)
+        try:
+            connection.do_handshake()
+        except OSError as ex:
+            with self.stats_lock:
+                self.handshakes_failed += 1
+            self.metrics.add("wurf_errors_total", kind="tls_handshake")
+            print(
+                "TLS handshake with %s failed: %s" % (client_address[0], ex),
+                file=sys.stderr,
+            )
+            return False
+        duration = time.monotonic() - start
+        self.metrics.observe("wurf_tls_handshake_seconds", duration)
+        with self.stats_lock:
+            self.handshakes += 1
+            self.handshakes_resumed += connection.session_reused
+            self.handshake_time += duration
+            self.handshake_time_max = max(self.handshake_time_max, duration)
+        return True
+
+    def partial_upload(self, name, size, digest=None) -> PartialUpload:
+        with self.uploads_lock:
+            if (name, size, digest) not in self.uploads:
+                self.uploads[name, size, digest] = PartialUpload(name, size, digest)
+            return self.uploads[name, size, digest]
+
+    def throttle(self, client_ip):
+        """Returns the Throttle for a new connection from client_ip, if any
+
+        Connections from the same client share a bucket, which is dropped
+        with the last of them (see release_throttle).
+        """
+        buckets = [self.rate_bucket] if self.rate_bucket else []
+        if client_rate:
+            with self.client_buckets_lock:
+                if client_ip not in self.client_buckets:
+                    self.client_buckets[client_ip] = [TokenBucket(client_rate), 0]
+                self.client_buckets[client_ip][1] += 1
+                buckets.append(self.client_buckets[client_ip][0])
+        return Throttle(*buckets) if buckets else None
+
+    def release_throttle(self, client_ip):
+        if client_rate:
+            with self.client_buckets_lock:
+                self.client_buckets[client_ip][1] -= 1
+                if not self.client_buckets[client_ip][1]:
+                    del self.client_buckets[client_ip]
+
+    def metrics_text(self) -> str:
+        with self.downloads.lock:
+            gauges = {
+                "wurf_active_transfers": self.downloads.active,
+                "wurf_downloads_left": self.downloads.left,
+            }
+        if self.metrics_dir is None:
+            return self.metrics.render(gauges)
+        import pickle
+
+        self.publish_metrics(force=True)
+        metrics = Metrics()
+        for name in os.listdir(self.metrics_dir):
+            if ".tmp-" in name:
+                continue
+            with contextlib.suppress(OSError, EOFError, pickle.UnpicklingError):
+                with open(os.path.join(self.metrics_dir, name), "rb") as f:
+                    metrics.merge(pickle.load(f))
+        return metrics.render(gauges)
+
+    def publish_metrics(self, force=False):
+        """Write the metrics of this worker for the others to add up"""
+        import pickle
+
+        changes, published = self.metrics_published
+        now = time.monotonic()
+        if self.metrics.changes == changes or (
+            not force and now - published < METRICS_PUBLISH_INTERVAL
+        ):
+            return
+        with self.metrics.lock:
+            changes = self.metrics.changes
+            data = pickle.dumps(self.metrics.values)
+        tmpname = "%s.tmp-%d" % (self.metrics_file, threading.get_ident())
+        with open(tmpname, "wb") as f:
+            f.write(data)
+        os.replace(tmpname, self.metrics_file)
+        self.metrics_published = (changes, now)
+
+    def serve_until_done(self):
+        while not self.downloads.finished():
+            self.handle_request()
+            if self.metrics_file is not None:
+                self.publish_metrics()
+        self.close_idle_connections()
+        self.pool.shutdown()
+
+    def serve_workers(self, count, prepare):
+        """Serve until done in count worker processes, forked from this one
+
+        prepare is called in each worker before it starts serving. Returns
+        once all the workers are done, False if one of them failed.
+        """
+        import pickle, select, signal, tempfile, traceback
+
+        self.metrics_dir = tempfile.mkdtemp(prefix="wurf-metrics-")
+        workers = {}
+        for index in range(count):
+            reader, writer = os.pipe()
+            pid = os.fork()
+            if pid:
+                os.close(writer)
+                workers[reader] = pid
+                continue
+
+            status = 1
+            try:
+                os.close(reader)
+                if index and self.reuse_port:
+                    self.socket.close()
+                    self.socket = socket.socket(self.address_family, self.socket_type)
+                    self.listen()
+                else:
+                    # Workers sharing a socket race for every connection:
+                    # the losers must not block in accept().
+                    self.socket.setblocking(False)
+                # The parent keeps what it measured before the fork.
+                self.metrics = Metrics()
+                self.metrics_file = os.path.join(self.metrics_dir, str(index))
+                self.request_ids = itertools.count(index + 1, count)
+                prepare()
+                self.serve_until_done()
+                self.publish_metrics(force=True)
+                with open(writer, "wb") as pipe:
+                    pickle.dump(self.stats(), pipe)
+                status = 0
+            except Exception:
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(status)
+
+        self.socket.close()
+        failed = False
+        try:
+            received = {reader: bytearray() for reader in workers}
+            while workers:
+                readable, _, _ = select.select(list(workers), [], [])
+                for reader in readable:
+                    data = os.read(reader, COPY_BUFFER_SIZE)
+                    if data:
+                        received[reader] += data
+                        continue
+                    os.close(reader)
+                    _, status = os.waitpid(workers.pop(reader), 0)
+                    if status == 0:
+                        self.merge_stats(pickle.loads(received[reader]))
+                    elif not failed:
+                        # The downloads it had in progress are never given
+                        # back: the others would wait for them forever.
+                        failed = True
+                        print("A worker failed, stopping the others", file=sys.stderr)
+                        for pid in workers.values():
+                            os.kill(pid, signal.SIGTERM)
+        finally:
+            for pid in workers.values():
+                with contextlib.suppress(OSError):
+                    os.kill(pid, signal.SIGTERM)
+            shutil.rmtree(self.metrics_dir, ignore_errors=True)
+        return not failed
+
+    def stats(self) -> dict:
+        """The metrics and TLS statistics, for the parent of a worker"""
+        with self.stats_lock:
+            return {
+                "metrics": self.metrics.values,
+                "handshakes": self.handshakes,
+                "handshakes_resumed": self.handshakes_resumed,
+                "handshakes_failed": self.handshakes_failed,
+                "handshake_time": self.handshake_time,
+                "handshake_time_max": self.handshake_time_max,
+            }
+
+    def merge_stats(self, stats: dict):
+        """Add the stats() of a worker to those of this server"""
+        self.metrics.merge(stats["metrics"])
+        with self.stats_lock:
+            self.handshakes += stats["handshakes"]
+            self.handshakes_resumed += stats["handshakes_resumed"]
+            self.handshakes_failed += stats["handshakes_failed"]
+            self.handshake_time += stats["handshake_time"]
+            self.handshake_time_max = max(
+                self.handshake_time_max, stats["handshake_time_max"]
+            )
+
+    def print_summary(self):
+        duration, downloads = self.metrics.total(
+            "wurf_transfer_duration_seconds", direction="download"
+        )
+        ttfb, responses = self.metrics.total("wurf_time_to_first_byte_seconds")
+        sent = self.metrics.total("wurf_sent_bytes_total")
+        if downloads:
+            print(
+                "Sent %d bytes in %d downloads, %.1f MB/s and %.1f ms to first "
+                "byte on average"
+                % (
+                    sent,
+                    downloads,
+                    sent / max(duration, 1e-6) / 1e6,
+                    ttfb / max(responses, 1) * 1e3,
+                ),
+                file=sys.stderr,
+            )
+        uploads = self.metrics.total("wurf_transfers_total", direction="upload")
+        if uploads:
+            print(
+                "Received %d bytes in %d uploads"
+                % (self.metrics.total("wurf_received_bytes_total"), uploads),
+                file=sys.stderr,
+            )
+        errors = self.metrics.total("wurf_errors_total")
+        if errors:
+            print("Errors: %d" % errors, file=sys.stderr)
+        if self.ssl_context is not None:
+            print(
+                "TLS handshakes: %d (%d resumed, %d failed), "
+                "%.1f ms average, %.1f ms max"
+                % (
+                    self.handshakes,
+                    self.handshakes_resumed,
+                    self.handshakes_failed,
+                    self.handshake_time / max(self.handshakes, 1) * 1e3,
+                    self.handshake_time_max * 1e3,
+                ),
+                file=sys.stderr,
+            )
+
+    def close_idle_connections(self):
+        """Close the kept-alive connections waiting for a new request"""
+        with self.idle_lock:
+            self.closing = True
+            for connection in self.idle:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
 
 
 # Main class implementing an HTTP-Requesthandler, that serves just a single
@@ -92,70 +2287,413 @@ class ForkingHTTPServer(http.server.HTTPServer):
 
 class FileServHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
     server_version = "Simons FileServer"
-    protocol_version = "HTTP/1.0"
+    protocol_version = "HTTP/1.1"
+    timeout = TRANSFER_TIMEOUT
+    # The headers and the body go out in separate writes: on a kept-alive
+    # connection, Nagle's algorithm would hold the body back until the
+    # client acknowledges the headers, which it delays.
+    disable_nagle_algorithm = True
 
     filename = "."
+    archive_ext = ""
+    index = None
+    digest = None
+    phases = None
+    status = None
+    transferred = 0
+
+    def setup(self):
+        super().setup()
+        self.requests_served = 0
+        self.throttle = self.server.throttle(self.client_address[0])
+        if self.throttle is not None:
+            self.rfile = ThrottledReader(self.rfile, self.throttle)
+            self.wfile = ThrottledWriter(self.wfile, self.throttle)
+
+    def finish(self):
+        try:
+            super().finish()
+        finally:
+            self.server.release_throttle(self.client_address[0])
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self.wait_for_request():
+            self.handle_one_request()
+
+    def handle_one_request(self):
+        if tracer is None and profile_dir is None:
+            super().handle_one_request()
+            return
+
+        # The first request of a connection gets the phases of the connection.
+        if tracer is not None:
+            self.phases = self.server.connection_phases.phases or {}
+            self.server.connection_phases.phases = None
+        self.status = None
+        self.transferred = 0
+        self.trace_start = time.perf_counter()
+        start = time.time()
+
+        profiler = None
+        if profile_dir is not None:
+            import cProfile
+
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Only one profiler may run at once on newer Pythons.
+                profiler = None
+        try:
+            super().handle_one_request()
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            duration = time.perf_counter() - self.trace_start
+            if getattr(self, "raw_requestline", None):
+                self.requests_served += 1
+                request_id = next(self.server.request_ids)
+                if tracer is not None:
+                    tracer.write(
+                        {
+                            "time": start,
+                            "request": request_id,
+                            "client": self.client_address[0],
+                            "connection_request": self.requests_served,
+                            "method": self.command,
+                            "path": self.path,
+                            "status": self.status,
+                            "bytes": self.transferred,
+                            "duration": duration,
+                            "phases": self.phases,
+                        }
+                    )
+                if profiler is not None:
+                    profiler.dump_stats(
+                        os.path.join(
+                            profile_dir,
+                            "%06d-%s-%s.pstats" % (request_id, self.command, self.status),
+                        )
+                    )
+
+    def wait_for_request(self):
+        """Wait for the next request on a kept-alive connection
+
+        Returns False when the client closes the connection or stays idle
+        for too long, or when the server is done.
+        """
+        with self.server.idle_lock:
+            if self.server.closing:
+                return False
+            self.server.idle.add(self.connection)
+        try:
+            self.connection.settimeout(KEEPALIVE_TIMEOUT)
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            with self.server.idle_lock:
+                self.server.idle.discard(self.connection)
+            self.connection.settimeout(self.timeout)
+
+    def parse_request(self):
+        self.request_start = time.monotonic()
+        # browse() points these at the file or subtree asked for: each
+        # request on a kept-alive connection starts from the served path.
+        self.filename = type(self).filename
+        self.archive_ext = type(self).archive_ext
+        self.digest = None
+        if self.phases is not None:
+            self.phases["read_request"] = time.perf_counter() - self.trace_start
+        return super().parse_request()
 
     def log_request(self, code="-", size="-"):
-        if code == 200:
+        self.status = code
+        if isinstance(code, int):
+            self.server.metrics.add("wurf_requests_total", code=int(code))
+        # Metrics get scraped every few seconds, don't log them.
+        if code in (200, 206) and self.path != METRICS_PATH:
             super().log_request(code, size)
 
+    def record_transfer(self, direction, size, duration):
+        self.transferred = size
+        metrics = self.server.metrics
+        metrics.add("wurf_transfers_total", direction=direction)
+        metrics.observe("wurf_transfer_duration_seconds", duration, direction=direction)
+        metrics.observe(
+            "wurf_transfer_throughput_bytes_per_second",
+            size / max(duration, 1e-6),
+            direction=direction,
+        )
+
+    def log_transfer(self, size, duration, method):
+        self.server.metrics.add("wurf_sent_bytes_total", size)
+        self.record_transfer("download", size, duration)
+        self.log_message(
+            "sent %d bytes in %.3f s (%.1f MB/s, %s)",
+            size,
+            duration,
+            size / max(duration, 1e-6) / 1e6,
+            method,
+        )
+
+    def file_etags(self, st):
+        """Return the ETags of the file, the digest based one first if known
+
+        Both stay valid, so that a client seeing the ETag change when the
+        digest becomes known can still resume its download.
+        """
+        etag, _ = file_validators(st)
+        self.digest = self.server.digests.lookup(self.filename, st)
+        if self.digest is None:
+            return [etag]
+        return [digest_etag(self.digest), etag]
+
+    def not_modified(self, st, etags):
+        """Whether the client already has this version of the file"""
+        if_none_match = self.headers["If-None-Match"]
+        if if_none_match:
+            if if_none_match.strip() == "*":
+                return True
+            for tag in if_none_match.split(","):
+                tag = tag.strip()
+                tag = tag[2:] if tag.startswith("W/") else tag
+                if tag.endswith('-gzip"'):
+                    tag = tag[: -len('-gzip"')] + '"'
+                if tag in etags:
+                    return True
+            return False
+
+        if_modified_since = self.headers["If-Modified-Since"]
+        if not if_modified_since:
+            return False
+        try:
+            date = email.utils.parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        return int(st.st_mtime) <= date.timestamp()
+
+    def send_not_modified(self, st, etag):
+        self.send_response(304)
+        if encoding != "off":
+            self.send_header("Vary", "Accept-Encoding")
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", file_validators(st)[1])
+        self.end_headers()
+
+    def if_range_matches(self, st, etags):
+        # Without If-Range, the Range header always applies. Otherwise the
+        # client asks for a range of the version it already has: either an
+        # exact strong ETag or the Last-Modified date.
+        if_range = self.headers["If-Range"]
+        if not if_range:
+            return True
+        if_range = if_range.strip()
+        if if_range.startswith('"'):
+            return if_range in etags
+        if if_range.startswith("W/"):
+            return False
+        try:
+            date = email.utils.parsedate_to_datetime(if_range)
+        except (TypeError, ValueError):
+            return False
+        # A modification date is only a strong validator once the file
+        # has been left alone for more than a second.
+        return date.timestamp() == int(st.st_mtime) and time.time() - st.st_mtime > 1
+
+    def byterange_part_header(self, boundary, first, last, st):
+        return (
+            b"\r\n--%b\r\n"
+            b"Content-Type: application/octet-stream\r\n"
+            b"Content-Range: bytes %d-%d/%d\r\n\r\n"
+            % (boundary, first, last, st.st_size)
+        )
+
+    def accepts_gzip(self):
+        for coding in (self.headers["Accept-Encoding"] or "").split(","):
+            name, *params = [part.strip() for part in coding.split(";")]
+            q = 1.0
+            for param in params:
+                key, _, value = param.partition("=")
+                if key.strip().lower() == "q":
+                    try:
+                        q = float(value)
+                    except ValueError:
+                        q = 0.0
+            if name.lower() in ("gzip", "x-gzip", "*") and q > 0:
+                return True
+        return False
+
+    def wants_gzip(self):
+        """Whether the file is to be sent gzip encoded to this client"""
+        return (
+            encoding == "gzip"
+            and self.accepts_gzip()
+            and file_compressible(self.filename)
+        )
+
+    def send_length_header(self, length):
+        if length is not None:
+            self.send_header("Content-Length", str(length))
+        elif self.request_version >= "HTTP/1.1":
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            # The end of the connection marks the end of the body.
+            self.send_header("Connection", "close")
+
+    def send_download_headers(
+        self, st, ranges, content_encoding=None, archive_size=None, layout=None
+    ):
+        """Send the response headers for the file or directory download
+
+        The size of a compressed directory archive or of a gzip encoded file
+        is only known when it comes from the cache; the one of an uncompressed
+        tar archive comes from its layout, which stands in for st. Returns
+        the multipart boundary when several ranges are sent.
+        """
+        boundary = None
+        self.send_response(200 if ranges is None else 206)
+        if ranges is not None and len(ranges) > 1:
+            boundary = os.urandom(12).hex().encode("ascii")
+            self.send_header(
+                "Content-Type", "multipart/byteranges; boundary=%s" % boundary.decode()
+            )
+        else:
+            self.send_header("Content-Type", "application/octet-stream")
+        self.send_header(
+            "Content-Disposition",
+            "attachment;filename=%s"
+            % urllib.parse.quote(os.path.basename(self.filename + self.archive_ext)),
+        )
+
+        if os.path.isfile(self.filename) or layout:
+            etag, last_modified = file_validators(st)
+            self.send_header("Accept-Ranges", "bytes")
+            if layout:
+                etag = layout.etag
+            elif encoding != "off":
+                self.send_header("Vary", "Accept-Encoding")
+            if self.digest is not None:
+                etag = digest_etag(self.digest)
+            if content_encoding:
+                # The encoded file is a different representation.
+                etag = etag[:-1] + '-%s"' % content_encoding
+                self.send_header("Content-Encoding", content_encoding)
+            elif self.digest is not None:
+                for header in digest_headers(self.digest):
+                    self.send_header(*header)
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
+            if content_encoding:
+                length = archive_size
+            elif ranges is None:
+                length = st.st_size
+            elif boundary is None:
+                first, last = ranges[0]
+                length = last - first + 1
+                self.send_header(
+                    "Content-Range", "bytes %d-%d/%d" % (first, last, st.st_size)
+                )
+            else:
+                length = len(b"\r\n--%b--\r\n" % boundary)
+                for first, last in ranges:
+                    length += len(self.byterange_part_header(boundary, first, last, st))
+                    length += last - first + 1
+            self.send_length_header(length)
+        else:
+            self.send_header("Accept-Ranges", "none")
+            self.send_length_header(archive_size)
+        self.end_headers()
+        return boundary
+
+    def send_unavailable(self):
+        # Every download left is in progress; one may still be given back.
+        # The request body, if any, is left unread.
+        self.send_response(503, "Download limit reached")
+        self.send_header("Retry-After", "10")
+        self.send_header("Content-Length", "0")
+        self.send_header("Connection", "close")
+        self.end_headers()
+
     def do_POST(self):
-        global maxdownloads, upload
+        if self.server.swarm and urllib.parse.urlsplit(self.path).path == SWARM_PATH:
+            self.swarm_announce()
+            return
 
         if not upload:
             self.send_error(501, "Unsupported method (POST)")
             return
 
-        multi_form = decode_multipart_form_data(self.rfile, self.headers)
-
-        for form_dict, content in multi_form:
-            if form_dict.get("name") == "upfile":
-                break
-        else:
-            # Went through without break, did not find
-            self.send_error(403, "No upload provided")
+        if self.headers.get_content_type() != "multipart/form-data":
+            self.receive_raw_upload()
             return
 
-        if not content or not form_dict.get("filename"):
-            self.send_error(403, "No upload provided")
+        if not self.server.downloads.begin():
+            self.send_unavailable()
             return
 
-        upfilename = form_dict["filename"]
+        completed = False
+        try:
+            completed = self.receive_upload()
+        finally:
+            self.server.downloads.end(completed=completed)
 
-        if "\\" in upfilename:
-            upfilename = upfilename.rsplit("\\", 1)[-1]
+    def receive_upload(self):
+        """Receive the upfile of a multipart form, returns True on success"""
+        try:
+            multi_form = decode_multipart_form_data(self.rfile, self.headers)
 
-        upfilename = os.path.basename(upfilename)
+            for form_dict, content in multi_form:
+                if form_dict.get("name") == "upfile":
+                    break
+            else:
+                # Went through without break, did not find
+                self.send_error(403, "No upload provided")
+                return
 
-        destfile = None
-        for suffix in ["", ".1", ".2", ".3", ".4", ".5", ".6", ".7", ".8", ".9"]:
-            destfilename = os.path.join(".", upfilename + suffix)
-            try:
-                destfile = os.open(
-                    destfilename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644
-                )
-                break
-            except OSError as ex:
-                if ex.errno == errno.EEXIST:
-                    continue
-                raise
+            first_chunk = next(content, b"")
+        except ValueError as ex:
+            self.send_error(400, "Malformed upload: %s" % ex)
+            return
+
+        if not first_chunk or not form_dict.get("filename"):
+            self.send_error(403, "No upload provided")
+            return
 
-        if not destfile:
-            upfilename += "."
-            destfile, destfilename = tempfile.mkstemp(prefix=upfilename, dir=".")
+        upfilename = upload_filename(form_dict["filename"])
+        destfile, destfilename = create_upload_file(upfilename)
 
         print(
             "Accepting uploaded file: %s -> %s" % (upfilename, destfilename),
             file=sys.stderr,
         )
 
-        with BytesIO(content) as readfile:
-            with open(destfile, "wb") as writefile:
-                shutil.copyfileobj(readfile, writefile)
+        start = time.monotonic()
+        received = 0
+        digest = hashlib.sha256()
+        try:
+            with open(destfile, "wb") as writefile, timed_phase(self.phases, "body"):
+                for chunk in itertools.chain([first_chunk], content):
+                    self.server.metrics.add("wurf_received_bytes_total", len(chunk))
+                    received += len(chunk)
+                    digest.update(chunk)
+                    writefile.write(chunk)
+                for _ in multi_form:
+                    pass
+        except (ValueError, OSError) as ex:
+            os.unlink(destfilename)
+            print("Upload of %s interrupted: %s" % (upfilename, ex), file=sys.stderr)
+            self.server.metrics.add("wurf_errors_total", kind="broken_upload")
+            self.send_error(400, "Upload interrupted")
+            return
+        self.record_transfer("upload", received, time.monotonic() - start)
 
-        # if upfile.done == -1:
-        #   self.send_error (408, "upload interrupted")
+        print(
+            "Received %s, sha-256 %s" % (destfilename, digest.hexdigest()),
+            file=sys.stderr,
+        )
 
         txt = b"""\
               <!DOCTYPE html>
@@ -173,12 +2711,228 @@ class FileServHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
         self.end_headers()
         self.wfile.write(txt)
 
-        maxdownloads -= 1
+        return True
 
-        return
+    def do_PUT(self):
+        if not upload:
+            self.send_error(501, "Unsupported method (PUT)")
+            return
+
+        self.receive_raw_upload()
+
+    def swarm_announce(self):
+        """Register a swarm peer, answering with what it should fetch where"""
+        try:
+            length = int(self.headers["Content-Length"])
+            if not 0 <= length <= SWARM_MAX_ANNOUNCE_SIZE:
+                raise ValueError("announce too large")
+            announce = json.loads(self.rfile.read(length))
+            port = int(announce["port"])
+            have = int(announce["have"], 16)
+            want = int(announce.get("want", 1))
+        except (TypeError, KeyError, ValueError) as ex:
+            self.send_error(400, "Invalid announce: %s" % ex)
+            return
+        host = self.client_address[0]
+        if ":" in host:
+            host = "[%s]" % host
+        answer = self.server.swarm.announce(
+            "http://%s:%d/" % (host, port), have, want, bool(announce.get("leave"))
+        )
+        self.send_page("application/json", json.dumps(answer).encode("utf-8"))
+
+    def send_text(self, code, text, headers=()):
+        txt = text.encode("utf-8", "surrogateescape") + b"\n"
+        self.send_response(code)
+        for header in headers:
+            self.send_header(*header)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(txt)))
+        self.end_headers()
+        self.wfile.write(txt)
+
+    def receive_raw_upload(self):
+        """Receive a file sent as the whole request body, or a piece of it"""
+        upfilename = upload_filename(
+            self.headers.get_filename()
+            or urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        )
+        if not upfilename or upfilename.startswith(".wurf-upload-"):
+            self.send_error(400, "No file name given")
+            return
+
+        if self.headers["Content-Range"]:
+            self.receive_piece(upfilename)
+            return
+
+        if not self.server.downloads.begin():
+            self.send_unavailable()
+            return
+
+        completed = False
+        try:
+            destfile, destfilename = create_upload_file(upfilename)
+            print(
+                "Accepting uploaded file: %s -> %s" % (upfilename, destfilename),
+                file=sys.stderr,
+            )
+            start = time.monotonic()
+            received = 0
+            digest = hashlib.sha256()
+            try:
+                with open(destfile, "wb") as writefile, timed_phase(self.phases, "body"):
+                    for chunk in read_body(self.rfile, self.headers):
+                        self.server.metrics.add("wurf_received_bytes_total", len(chunk))
+                        received += len(chunk)
+                        digest.update(chunk)
+                        writefile.write(chunk)
+            except (ValueError, OSError) as ex:
+                os.unlink(destfilename)
+                print("Upload of %s interrupted: %s" % (upfilename, ex), file=sys.stderr)
+                self.server.metrics.add("wurf_errors_total", kind="broken_upload")
+                self.send_error(400, "Upload interrupted")
+                return
+
+            # The client may have given the digest of what it sent.
+            expected = parse_digest(self.headers)
+            if expected is not None and expected != digest.digest():
+                os.unlink(destfilename)
+                print("Upload of %s corrupted: digest mismatch" % upfilename, file=sys.stderr)
+                self.server.metrics.add("wurf_errors_total", kind="digest_mismatch")
+                self.send_error(400, "Digest mismatch")
+                return
+            self.record_transfer("upload", received, time.monotonic() - start)
+
+            print(
+                "Received %s, sha-256 %s" % (destfilename, digest.hexdigest()),
+                file=sys.stderr,
+            )
+            self.send_text(
+                201,
+                "Stored as %s, sha-256 %s"
+                % (os.path.basename(destfilename), digest.hexdigest()),
+            )
+            completed = True
+        finally:
+            self.server.downloads.end(completed=completed)
+
+    def receive_piece(self, upfilename):
+        """Receive a piece of an upload, as given by its Content-Range"""
+        unit, _, spec = self.headers["Content-Range"].strip().partition(" ")
+        pieces, _, size = spec.partition("/")
+        try:
+            size = int(size)
+            if pieces == "*":
+                first, last = 0, -1
+            else:
+                first, last = [int(bound) for bound in pieces.split("-")]
+            if unit != "bytes" or size <= 0 or first < 0 or last >= size:
+                raise ValueError
+        except ValueError:
+            self.send_error(400, "Invalid Content-Range")
+            return
+
+        # Pieces don't count as downloads, only the upload they complete.
+        self.server.downloads.begin(counts=False)
+        try:
+            digest = parse_digest(self.headers, ("Repr-Digest",))
+            try:
+                partial = self.server.partial_upload(upfilename, size, digest)
+                fd = os.open(partial.partname, os.O_WRONLY)
+            except OSError as ex:
+                print(
+                    "Piece %d-%d of %s refused: %s" % (first, last, upfilename, ex),
+                    file=sys.stderr,
+                )
+                self.close_connection = True
+                # The part file is gone once another piece completed the upload.
+                if isinstance(ex, FileNotFoundError):
+                    self.send_error(410, "Upload no longer in progress")
+                else:
+                    self.send_error(500, "Cannot store the upload")
+                return
+            start = time.monotonic()
+            offset = first
+            with timed_phase(self.phases, "body"):
+                try:
+                    for chunk in read_body(self.rfile, self.headers):
+                        if offset + len(chunk) > last + 1:
+                            raise ValueError("piece larger than its range")
+                        self.server.metrics.add("wurf_received_bytes_total", len(chunk))
+                        view = memoryview(chunk)
+                        while view:
+                            written = os.pwrite(fd, view, offset)
+                            view = view[written:]
+                            offset += written
+                except (ValueError, OSError) as ex:
+                    print(
+                        "Piece %d-%d of %s interrupted: %s" % (first, last, upfilename, ex),
+                        file=sys.stderr,
+                    )
+                    self.server.metrics.add("wurf_errors_total", kind="broken_upload")
+                    self.close_connection = True
+                finally:
+                    os.close(fd)
+                    if offset > first:
+                        partial.add(first, offset - 1)
+            if first <= last == offset - 1:
+                self.record_transfer("upload", offset - first, time.monotonic() - start)
+
+            if partial.finish():
+                with self.server.uploads_lock:
+                    del self.server.uploads[upfilename, size, digest]
+                # The pieces may each be fine and still not make up the file
+                # the client meant, so the whole of it is checked.
+                if digest is not None and sha256_file(partial.partname).digest() != digest:
+                    os.unlink(partial.partname)
+                    partial.remove()
+                    print("Upload of %s corrupted: digest mismatch" % upfilename, file=sys.stderr)
+                    self.server.metrics.add("wurf_errors_total", kind="digest_mismatch")
+                    self.send_error(400, "Digest mismatch")
+                    return
+                destfile, destfilename = create_upload_file(upfilename)
+                os.close(destfile)
+                os.replace(partial.partname, destfilename)
+                partial.remove()
+                print(
+                    "Accepted uploaded file: %s -> %s" % (upfilename, destfilename),
+                    file=sys.stderr,
+                )
+                self.server.downloads.complete()
+                self.send_text(201, "Stored as %s" % os.path.basename(destfilename))
+            elif offset != last + 1:
+                # The client has usually gone away by now.
+                with contextlib.suppress(OSError):
+                    self.send_text(
+                        400,
+                        "Piece %d-%d truncated at %d" % (first, last, offset),
+                        partial.range_headers() + [("Connection", "close")],
+                    )
+            else:
+                self.send_text(
+                    202,
+                    "Received %d of %d bytes" % (partial.received_size(), size),
+                    partial.range_headers(),
+                )
+        finally:
+            self.server.downloads.end(counts=False)
+
+    def do_HEAD(self):
+        self.do_GET()
 
     def do_GET(self):
-        global maxdownloads, cpid, compressed, upload
+        if urllib.parse.urlsplit(self.path).path == METRICS_PATH:
+            self.send_page(
+                "text/plain; version=0.0.4; charset=utf-8",
+                self.server.metrics_text().encode("utf-8"),
+            )
+            return
+
+        if self.server.swarm and urllib.parse.urlsplit(self.path).path == SWARM_PATH:
+            with timed_phase(self.phases, "manifest"):
+                document = self.server.swarm.document()
+            self.send_page("application/json", json.dumps(document).encode("utf-8"))
+            return
 
         # Form for uploading a file
         if upload:
@@ -199,112 +2953,339 @@ class FileServHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
             self.send_header("Content-Type", "text/html")
             self.send_header("Content-Length", str(len(txt)))
             self.end_headers()
-            self.wfile.write(txt)
+            if self.command != "HEAD":
+                self.wfile.write(txt)
+            return
+
+        if self.index is not None:
+            self.browse()
             return
 
         # Redirect any request to the filename of the file to serve.
         # This hands over the filename to the client.
 
+        url = urllib.parse.urlsplit(self.path)
         self.path = urllib.parse.quote(urllib.parse.unquote(self.path))
-        location = "/" + urllib.parse.quote(os.path.basename(self.filename))
-        if os.path.isdir(self.filename):
-            if compressed == "gz":
-                location += ".tar.gz"
-            elif compressed == "bz2":
-                location += ".tar.bz2"
-            elif compressed == "zip":
-                location += ".zip"
-            else:
-                location += ".tar"
+        location = "/" + urllib.parse.quote(
+            os.path.basename(self.filename + self.archive_ext)
+        )
+
+        if url.query == "manifest" and urllib.parse.quote(
+            urllib.parse.unquote(url.path)
+        ) == location:
+            self.send_manifest()
+            return
 
         if self.path != location:
-            txt = (
-                """\
-                <!DOCTYPE html>
-                <html>
-                   <head><title>302 Found</title></head>
-                   <body>302 Found <a href="%s">here</a>.</body>
-                </html>\n"""
-                % location
-            )
-            txt = txt.encode("ascii")
-            self.send_response(302)
-            self.send_header("Location", location)
-            self.send_header("Content-Type", "text/html")
-            self.send_header("Content-Length", str(len(txt)))
-            self.end_headers()
+            self.send_redirect(location)
+            return
+
+        self.serve_download()
+
+    def send_redirect(self, location):
+        txt = (
+            """\
+            <!DOCTYPE html>
+            <html>
+               <head><title>302 Found</title></head>
+               <body>302 Found <a href="%s">here</a>.</body>
+            </html>\n"""
+            % html.escape(location)
+        )
+        txt = txt.encode("ascii")
+        self.send_response(302)
+        self.send_header("Location", location)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(txt)))
+        self.end_headers()
+        if self.command != "HEAD":
             self.wfile.write(txt)
+
+    def send_manifest(self):
+        """Send the block manifest of the file, for clients updating a copy"""
+        if not os.path.isfile(self.filename):
+            self.send_error(404)
+            return
+        with timed_phase(self.phases, "manifest"):
+            manifest = self.server.manifests.get(self.filename)
+        self.send_page(MANIFEST_TYPE, manifest)
+
+    def send_page(self, content_type, txt):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(txt)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(txt)
+
+    def browse(self):
+        """Serve a listing, a file or a subtree archive of the tree"""
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query, keep_blank_values=True)
+        path = urllib.parse.unquote(url.path)
+        top = os.path.basename(self.filename)
+        location = "/" + urllib.parse.quote(top) + "/"
+
+        parts = path.split("/")
+        if len(parts) < 2 or parts[1] != top:
+            self.send_redirect(location)
+            return
+
+        # Never let a request out of the tree, whether by a ".." in the
+        # path or by a symlink pointing elsewhere.
+        names = [name for name in parts[2:] if name]
+        if any(name in (".", "..") or "\0" in name for name in names):
+            self.send_error(404)
+            return
+        target = os.path.join(self.filename, *names)
+        if not self.index.contains(target):
+            self.send_error(404)
+            return
+
+        if os.path.isdir(target):
+            if not path.endswith("/"):
+                self.send_redirect(urllib.parse.quote(path) + "/")
+            elif "archive" in query:
+                self.filename = target
+                self.serve_download()
+            else:
+                self.send_listing(path, os.path.join(*names) if names else "", query)
+        elif os.path.isfile(target):
+            self.filename = target
+            self.archive_ext = ""
+            if "manifest" in query:
+                self.send_manifest()
+            else:
+                self.serve_download()
+        else:
+            self.send_error(404)
+
+    def send_listing(self, path, relpath, query):
+        with timed_phase(self.phases, "listing"):
+            entries = self.index.listing(relpath)
+        if entries is None:
+            self.send_error(404)
             return
 
-        maxdownloads -= 1
+        name = os.path.basename(relpath) or os.path.basename(self.filename)
+        if query.get("format") == ["json"] or "application/json" in (
+            self.headers["Accept"] or ""
+        ):
+            listing = {
+                "path": path,
+                "archive": urllib.parse.quote(path) + "?archive",
+                "entries": [
+                    {
+                        "name": entry_name,
+                        "type": "directory" if is_dir else "file",
+                        "size": size,
+                        "mtime": mtime,
+                    }
+                    for entry_name, is_dir, size, mtime in entries
+                ],
+            }
+            self.send_page("application/json", json.dumps(listing).encode("utf-8"))
+            return
 
-        # let a separate process handle the actual download, so that
-        # multiple downloads can happen simultaneously.
+        rows = []
+        if relpath:
+            rows.append('<tr><td><a href="../">../</a></td><td></td><td></td></tr>')
+        for entry_name, is_dir, size, mtime in entries:
+            suffix = "/" if is_dir else ""
+            rows.append(
+                '<tr><td><a href="%s">%s</a></td><td>%s</td><td>%s</td></tr>'
+                % (
+                    html.escape(urllib.parse.quote(entry_name) + suffix),
+                    html.escape(entry_name + suffix),
+                    "" if is_dir else size,
+                    time.strftime("%Y-%m-%d %H:%M", time.localtime(mtime)),
+                )
+            )
+        txt = """\
+            <!DOCTYPE html>
+            <html>
+              <head><meta charset="utf-8"><title>Index of %s</title></head>
+              <body>
+                <h1>Index of %s</h1>
+                <p><a href="?archive">Download %s</a></p>
+                <table>
+                  %s
+                </table>
+              </body>
+            </html>
+            """ % (
+            html.escape(path),
+            html.escape(path),
+            html.escape(name + self.archive_ext),
+            "\n                  ".join(rows),
+        )
+        self.send_page("text/html; charset=utf-8", txt.encode("utf-8", "surrogateescape"))
 
-        cpid = os.fork()
+    def serve_download(self):
+        """Send the file or the directory archive, counting the download"""
+        if not os.path.isfile(self.filename) and not os.path.isdir(self.filename):
+            print("can only serve files or directories. Aborting.", file=sys.stderr)
+            self.send_error(404)
+            return
 
-        if cpid == 0:
-            # Child process
-            type = None
+        st = os.stat(self.filename)
+        layout = None
+        if os.path.isdir(self.filename) and not compressed:
+            with timed_phase(self.phases, "scan"):
+                st = layout = TarLayout(self.filename)
+        ranges = None
+        if os.path.isfile(self.filename) or layout:
+            if layout:
+                # The digest of the archive isn't known before it's sent.
+                self.digest = None
+                etags = [layout.etag]
+            else:
+                etags = self.file_etags(st)
+            if self.not_modified(st, etags):
+                etag = etags[0]
+                if not layout and self.wants_gzip():
+                    etag = etag[:-1] + '-gzip"'
+                self.send_not_modified(st, etag)
+                return
+            if self.headers["Range"] and self.if_range_matches(st, etags):
+                try:
+                    ranges = parse_byte_ranges(self.headers["Range"], st.st_size)
+                except ValueError:
+                    self.send_response(416)
+                    self.send_header("Content-Range", "bytes */%d" % st.st_size)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+
+        # Single files are sent gzip compressed to the clients accepting
+        # it, unless they ask for ranges or the file doesn't compress.
+        content_encoding = None
+        if os.path.isfile(self.filename) and ranges is None and self.wants_gzip():
+            content_encoding = "gzip"
+
+        if self.command == "HEAD":
+            self.send_download_headers(st, ranges, content_encoding, layout=layout)
+            return
 
-            if os.path.isfile(self.filename):
-                type = "file"
-            elif os.path.isdir(self.filename):
-                type = "dir"
+        # A ranged request only counts as a download when it includes the
+        # end of the file: resuming a download or fetching it in several
+        # segments uses up a single download.
 
-            if not type:
-                print("can only serve files or directories. Aborting.", file=sys.stderr)
-                sys.exit(1)
+        counts = ranges is None or any(last == st.st_size - 1 for _, last in ranges)
+        if not self.server.downloads.begin(counts):
+            self.send_unavailable()
+            return
 
-            self.send_response(200)
-            self.send_header("Content-Type", "application/octet-stream")
-            self.send_header(
-                "Content-Disposition",
-                "attachment;filename=%s"
-                % urllib.parse.quote(
-                    os.path.basename(self.filename + self.archive_ext)
-                ),
+        completed = False
+        try:
+            completed = self.send_download(st, ranges, content_encoding, layout)
+        except Exception as ex:
+            print(ex)
+            print("Connection broke. Aborting", file=sys.stderr)
+            self.server.metrics.add("wurf_errors_total", kind="broken_download")
+        finally:
+            self.server.downloads.end(counts, completed)
+            if not completed:
+                self.close_connection = True
+
+    def send_download(self, st, ranges, content_encoding=None, layout=None):
+        """Send the file or directory, returns True once all of it is sent"""
+        plain_file = os.path.isfile(self.filename) and not content_encoding
+        # In browse mode, only the archive of the whole tree is cached.
+        use_cache = archive_cache and archive_cache.path == self.filename
+        cached = None
+        if not plain_file and not layout and use_cache:
+            with timed_phase(self.phases, "cache_lookup"):
+                signature = archive_cache.signature()
+                cached = archive_cache.open(signature)
+
+        with timed_phase(self.phases, "headers"):
+            boundary = self.send_download_headers(
+                st,
+                ranges,
+                content_encoding,
+                cached and os.fstat(cached.fileno()).st_size,
+                layout,
             )
-            if os.path.isfile(self.filename):
-                self.send_header("Content-Length", str(os.path.getsize(self.filename)))
-            self.end_headers()
-
-            try:
-                if type == "file":
-                    with open(self.filename, "rb") as datafile:
-                        shutil.copyfileobj(datafile, self.wfile)
-                elif type == "dir":
-                    if compressed == "zip":
-                        with zipfile.ZipFile(
-                            self.wfile, "w", zipfile.ZIP_DEFLATED
-                        ) as zfile:
-                            stripoff = os.path.dirname(self.filename) + os.sep
-
-                            for root, dirs, files in os.walk(self.filename):
-                                for f in files:
-                                    filename = os.path.join(root, f)
-                                    if filename[: len(stripoff)] != stripoff:
-                                        raise RuntimeError(
-                                            "invalid filename assumptions, please report!"
-                                        )
-                                    zfile.write(filename, filename[len(stripoff) :])
-                    else:
-                        with tarfile.open(
-                            mode=("w|" + compressed), fileobj=self.wfile
-                        ) as tfile:
-                            tfile.add(
-                                self.filename, arcname=os.path.basename(self.filename)
-                            )
+        self.server.metrics.observe(
+            "wurf_time_to_first_byte_seconds", time.monotonic() - self.request_start
+        )
 
-            except Exception as ex:
-                print(ex)
-                print("Connection broke. Aborting", file=sys.stderr)
+        start = time.monotonic()
+        if plain_file or layout:
+            with contextlib.ExitStack() as stack, timed_phase(self.phases, "body"):
+                if layout:
+                    source, send = layout, send_tar
+                    method = "tar from the files"
+                else:
+                    source = stack.enter_context(open(self.filename, "rb"))
+                    send = send_file
+                    method = "tls copy" if tls else "sendfile"
+                if ranges is None:
+                    expected = st.st_size
+                    sent = send(source, self.connection, throttle=self.throttle)
+                elif len(ranges) == 1:
+                    first, last = ranges[0]
+                    expected = last - first + 1
+                    sent = send(source, self.connection, first, expected, self.throttle)
+                else:
+                    expected = sent = 0
+                    for first, last in ranges:
+                        self.wfile.write(self.byterange_part_header(boundary, first, last, st))
+                        expected += last - first + 1
+                        sent += send(
+                            source,
+                            self.connection,
+                            first,
+                            last - first + 1,
+                            self.throttle,
+                        )
+                    self.wfile.write(b"\r\n--%b--\r\n" % boundary)
+            self.log_transfer(sent, time.monotonic() - start, method)
+            return sent == expected
+
+        if cached:
+            with cached, timed_phase(self.phases, "body"):
+                expected = os.fstat(cached.fileno()).st_size
+                sent = send_file(cached, self.connection, throttle=self.throttle)
+            self.log_transfer(
+                sent,
+                time.monotonic() - start,
+                "cached %s" % ("gzip copy" if content_encoding else "archive"),
+            )
+            return sent == expected
+
+        chunked = self.request_version >= "HTTP/1.1"
+        wfile = self.wfile
+        if self.phases is not None:
+            wfile = TimedWriter(wfile, self.phases, "socket_write")
+        client = CountingWriter(ChunkedWriter(wfile) if chunked else wfile)
+        built = True
+        with timed_phase(self.phases, "body"):
+            if use_cache:
+                built = archive_cache.build(signature, client)
+            elif content_encoding:
+                write_gzip(self.filename, client)
+            else:
+                write_archive(self.filename, client)
+            if chunked:
+                client.fileobj.close()
+        kind = "gzip" if content_encoding else self.archive_ext + " archive"
+        if built:
+            self.server.metrics.observe(
+                "wurf_archive_build_seconds",
+                time.monotonic() - start,
+                kind="gzip" if content_encoding else "archive",
+            )
+            method = "%s on %d threads" % (kind, threads)
+        else:
+            method = "following the %s build" % kind
+        self.log_transfer(client.count, time.monotonic() - start, method)
+        return True
 
 
 def serve_files(filename, maxdown=1, ip_addr="", port=8080):
-    global maxdownloads
-
-    maxdownloads = maxdown
+    global archive_cache
 
     archive_ext = ""
     if filename and os.path.isdir(filename):
@@ -312,6 +3293,8 @@ def serve_files(filename, maxdown=1, ip_addr="", port=8080):
             archive_ext = ".tar.gz"
         elif compressed == "bz2":
             archive_ext = ".tar.bz2"
+        elif compressed == "xz":
+            archive_ext = ".tar.xz"
         elif compressed == "zip":
             archive_ext = ".zip"
         else:
@@ -323,18 +3306,72 @@ def serve_files(filename, maxdown=1, ip_addr="", port=8080):
     FileServHTTPRequestHandler.filename = filename
     FileServHTTPRequestHandler.archive_ext = archive_ext
 
+    if browse and archive_ext:
+        start = time.monotonic()
+        index = TreeIndex(filename)
+        print(
+            "Indexed %d directories and %d files in %.2f s"
+            % (index.totals() + (time.monotonic() - start,)),
+            file=sys.stderr,
+        )
+        FileServHTTPRequestHandler.index = index
+
+    # A cached archive only pays off when it's downloaded several times.
+    # Uncompressed tar archives need none, they're sent straight from the
+    # files.
+    prebuild_time = None
+    if cache == "prebuild" or (cache == "on" and maxdown > 1):
+        if archive_ext and compressed:
+            archive_cache = ArchiveCache(filename, archive_ext)
+            if cache == "prebuild":
+                print("Building %s archive..." % archive_ext, file=sys.stderr)
+        elif (
+            not archive_ext
+            and filename
+            and encoding == "gzip"
+            and file_compressible(filename)
+        ):
+            archive_cache = ArchiveCache(filename, ".gz")
+            if cache == "prebuild":
+                print("Building gzip copy...", file=sys.stderr)
+        if archive_cache and cache == "prebuild":
+            start = time.monotonic()
+            archive_cache.build(archive_cache.signature())
+            prebuild_time = time.monotonic() - start
+
     try:
-        httpd = ForkingHTTPServer((ip_addr, port), FileServHTTPRequestHandler)
+        httpd = ThreadPoolHTTPServer(
+            (ip_addr, port), FileServHTTPRequestHandler, maxdown, maxtransfers, workers
+        )
     except socket.error:
         print(
             "cannot bind to IP address '%s' port %d" % (ip_addr, port), file=sys.stderr
         )
         sys.exit(1)
+    if prebuild_time is not None:
+        httpd.metrics.observe(
+            "wurf_archive_build_seconds",
+            prebuild_time,
+            kind="archive" if archive_ext else "gzip",
+        )
+    if filename and os.path.isfile(filename) and swarm:
+        httpd.swarm = Swarm(filename, httpd.manifests)
+
+    # Start hashing the file right away, for the first clients to get its
+    # digest too. Each worker does so once forked.
+    def prepare():
+        if filename and os.path.isfile(filename):
+            httpd.digests.lookup(filename, os.stat(filename))
+
     listen_protocol = "https" if tls else "http"
     if not ip_addr:
-        ip_addr = find_ip()
+        ip_addr = find_ip() if discover else socket.gethostname()
     if ip_addr:
-        if filename:
+        if filename and FileServHTTPRequestHandler.index:
+            location = f"{listen_protocol}://{ip_addr}:{httpd.server_port}/" + urllib.parse.quote(
+                os.path.basename(filename)
+            ) + "/"
+        elif filename:
             location = f"{listen_protocol}://{ip_addr}:{httpd.server_port}/" + urllib.parse.quote(
                 os.path.basename(filename + archive_ext)
             )
@@ -343,9 +3380,8 @@ def serve_files(filename, maxdown=1, ip_addr="", port=8080):
 
         print("Now serving on %s" % location)
     if tls :
-        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
         try:
-            context.load_cert_chain(cert, key, keypass)
+            httpd.ssl_context = tls_context(cert, key, keypass)
         except ssl.SSLError:
             print("Unable to load certificate or key. Possibly missing or incorrect password.")
             sys.exit(1)
@@ -353,57 +3389,162 @@ def serve_files(filename, maxdown=1, ip_addr="", port=8080):
             print("Certificate or Key file is inaccessible or incorrect.")
             sys.exit(1)
 
-        with context.wrap_socket(httpd.socket, server_side=True) as ssock:
-            httpd.socket = ssock
-            while cpid != 0 and maxdownloads > 0:
-                httpd.handle_request()
+    if workers > 1:
+        completed = httpd.serve_workers(workers, prepare)
     else:
-        while cpid != 0 and maxdownloads > 0:
-            httpd.handle_request()
+        prepare()
+        httpd.serve_until_done()
+        completed = True
+    httpd.print_summary()
+    if not completed:
+        sys.exit(1)
 
 
 def usage(defport, defmaxdown, errmsg=None):
     name = os.path.basename(sys.argv[0])
     print(
         """
-    Usage: %s [-i <ip_addr>] [-p <port>] [-c <count>] [-t [--cert <cert_file>] [--key <key_file>] [--keypass <key_pass>]] <file>
-           %s [-i <ip_addr>] [-p <port>] [-c <count>] [-t [--cert <cert_file>] [--key <key_file>] [--keypass <key_pass>]] [-z|-j|-Z|-u] <dir>
-           %s [-i <ip_addr>] [-p <port>] [-c <count>] [-t [--cert <cert_file>] [--key <key_file>] [--keypass <key_pass>]] -s
-           %s [-i <ip_addr>] [-p <port>] [-c <count>] [-t [--cert <cert_file>] [--key <key_file>] [--keypass <key_pass>]] -U
+    Usage: %s [-i <ip_addr>|--no-discover] [-p <port>] [-c <count>] [--transfers <n>] [--workers <n>] [--rate <rate>] [--client-rate <rate>] [--trace <file>] [--profile <dir>] [-t [--cert <cert_file>] [--key <key_file>] [--keypass <key_pass>]] [--encoding <mode>] [--cache <mode>] [--swarm] <file>
+           %s [-i <ip_addr>|--no-discover] [-p <port>] [-c <count>] [--transfers <n>] [--workers <n>] [--rate <rate>] [--client-rate <rate>] [--trace <file>] [--profile <dir>] [-t [--cert <cert_file>] [--key <key_file>] [--keypass <key_pass>]] [-b] [-z|-j|-J|-Z|-u] [--level <level>] [--threads <n>] [--cache <mode>] <dir>
+           %s [-i <ip_addr>|--no-discover] [-p <port>] [-c <count>] [--transfers <n>] [--workers <n>] [--rate <rate>] [--client-rate <rate>] [--trace <file>] [--profile <dir>] [-t [--cert <cert_file>] [--key <key_file>] [--keypass <key_pass>]] -s
+           %s [-i <ip_addr>|--no-discover] [-p <port>] [-c <count>] [--transfers <n>] [--workers <n>] [--rate <rate>] [--client-rate <rate>] [--trace <file>] [--profile <dir>] [-t [--cert <cert_file>] [--key <key_file>] [--keypass <key_pass>]] -U
 
-           %s <url>
+           %s [-n <connections>] [-x] [--batch] [--delta] [--swarm [-c <count>]] <url>
 
     Serves a single file <count> times via http on port <port> on IP
-    address <ip_addr>.
+    address <ip_addr>. Without -i, the address to share is guessed from
+    the default route, or shown as the host name with --no-discover.
     When a directory is specified, an tar archive gets served. By default
     it is gzip compressed. You can specify -z for gzip compression,
-    -j for bzip2 compression, -Z for ZIP compression or -u for no compression.
+    -j for bzip2 compression, -J for xz compression, -Z for ZIP compression
+    or -u for no compression.
     You can configure your default compression method in the configuration
-    file described below.
+    file described below. Compression runs on <n> threads, by default
+    one per CPU, at the given <level> from 0 to 9. Files that are already
+    compressed, like pictures, videos or archives, are stored as they are.
+
+    When a directory is downloaded several times, its archive is built
+    once and kept in a cache until the directory changes. Use --cache off
+    to disable the cache, or --cache prebuild to build the archive before
+    serving. An uncompressed tar archive (-u) needs no cache: it is sent
+    straight from the files, with its exact size known beforehand, so
+    clients see their progress and can resume it or fetch it over several
+    connections with -n.
+
+    When -b is specified with a directory, wurf serves it as a tree of
+    browsable listings instead: every file can be downloaded on its own,
+    and every subdirectory as an archive. The listings are also available
+    as JSON with ?format=json. Each file or archive download counts
+    against <count>.
+
+    Single files are sent as they are. With --encoding gzip, they are sent
+    gzip compressed to the clients accepting it, unless they are already
+    compressed: this takes a core per download, and pays off on slow links
+    only. When a file is downloaded several times, its gzip copy is kept in
+    the cache too.
+
+    With --swarm, clients started with --swarm pass the file on to each
+    other, so that it mostly leaves the server once: the server hands out
+    the checksums of its chunks and the list of peers, and sends each
+    client the chunks no peer has yet.
 
     When -t is specified, wurf will use TLS to secure the connection. You must pass both a certificate and key in PEM format.
+    Returning clients resume their TLS session instead of a full handshake.
 
     When -s is specified instead of a filename, %s distributes itself.
 
     When -U is specified, wurf provides an upload form, allowing file uploads.
+    Files can also be sent as the whole body of a PUT or POST request, as
+    with curl -T <file> <url>. Large files can be sent in pieces, each one
+    a PUT with a Content-Range header such as "bytes 0-999999/5000000", in
+    any order or in parallel. Each answer lists the bytes received so far
+    in a Range header, and the range "*" only asks for it, so that an
+    interrupted upload can be resumed. Pieces of files with the same name
+    and size are kept apart by the Repr-Digest of the whole file, if given,
+    and the file is checked against it once all of it is there.
+    An upload counts once it completes.
+
+    At most <n> clients are served at once, the others wait for their turn.
+    A download only counts once it completes: a broken download can be
+    tried again. Connections are kept alive between requests and closed
+    after 15 idle seconds.
+
+    With --workers, wurf runs in <n> processes, each one serving up to
+    --transfers clients at once, so that it uses several cores. The count
+    and --rate hold for all of them together, and so do the metrics page
+    and the summary; --client-rate is per worker. It can't be used with
+    --swarm.
+
+    Use --rate to cap the total bandwidth, in bytes per second with an
+    optional k, M or G suffix, and --client-rate to cap the bandwidth of
+    each client. Transfers share the bandwidth evenly.
+
+    Metrics are served in the Prometheus text format on /_wurf/metrics:
+    requests, bytes sent and received, transfers, errors, and histograms
+    of the transfer durations and throughputs, time to first byte, TLS
+    handshakes and archive builds. A summary is printed at exit.
+
+    With --trace, a JSON line is appended to <file> for every request,
+    with the time spent in each phase: waiting for a thread, the TLS
+    handshake, reading the request, sending the headers and the body.
+    With --profile, every request runs under cProfile, and its statistics
+    are dumped in <dir>, in a .pstats file per request.
 
     defaults: count = %d, port = %d
 
     If started with an url as an argument, wurf acts as a client,
     downloading the file and saving it in the current directory.
+    When a partial copy of the file is already there, the client offers
+    to resume the download where it stopped. With -n, the file is fetched
+    in segments over <connections> parallel connections.
+
+    With -x, a directory archive is extracted as it is downloaded, into
+    a directory named after it, instead of being saved. With --batch, the
+    client asks no question: it keeps the suggested name, resumes partial
+    copies and never overwrites a file or directory.
+
+    With --delta, an existing copy of the file is updated instead: the
+    client fetches a manifest of checksums of the blocks of the file, and
+    only downloads the blocks it doesn't already have, even if they moved.
+
+    With --swarm, the client joins the swarm of a server started with
+    --swarm: it fetches chunks from the server and from the other peers,
+    and serves the chunks it has to them. Once done, it keeps serving
+    them until nobody asks for 5 seconds or it sent <count> copies.
+
+    Single files can be downloaded in ranges. A ranged request only counts
+    against <count> when it includes the end of the file, so a resumed
+    download is only counted once.
+
+    Files are hashed with SHA-256 in the background, and their digest is
+    sent as ETag and in the Repr-Digest header once known. Clients that
+    already have the file get 304 Not Modified. The client checks every
+    download against the digest, and the server checks uploads sent with a
+    Repr-Digest or Content-Digest header.
 
     You can specify different defaults in two locations: /etc/wurfrc
     and ~/.wurfrc can be INI-style config files containing the default
     port and the default count. The file in the home directory takes
-    precedence. The compression methods are "off", "gz", "bz2" or "zip".
+    precedence. The compression methods are "off", "gz", "bz2", "xz" or "zip".
 
     Sample file:
 
         [main]
         port = 8008
         count = 2
+        transfers = 100
+        workers = 1
+        rate = 10M
+        client_rate = 2M
         ip = 127.0.0.1
+        discover = on
         compressed = gz
+        browse = off
+        swarm = off
+        level = 6
+        threads = 4
+        cache = on
+        encoding = gzip
         tls = on
 
         [tls]
@@ -421,16 +3562,742 @@ def usage(defport, defmaxdown, errmsg=None):
     sys.exit(1)
 
 
-def wurf_client(url):
+def config_error(name, value, expected):
+    print(
+        "invalid %s in the configuration: %r. Please specify %s." % (name, value, expected),
+        file=sys.stderr,
+    )
+    sys.exit(1)
+
+
+# Segmented downloads fetch a file over several connections at once, each
+# one asking for its own byte range and writing it at its offset in the
+# destination file. This helps on links where a single TCP stream only
+# gets a fraction of the bandwidth.
+
+SEGMENT_MIN_SIZE = 4 * 1024 * 1024
+
+
+def open_range(url, segment, size, etag):
+    """Ask for the segment (first, last) of the size bytes file at url
+
+    The ETag makes sure the range comes from the right version of the file.
+    Raises OSError if the server doesn't serve the range.
+    """
+    import urllib.request
+
+    first, last = segment
+    request = urllib.request.Request(url)
+    request.add_header("Range", "bytes=%d-%d" % (first, last))
+    request.add_header("If-Range", etag)
+    response = urllib.request.urlopen(request)
+    content_range = "bytes %d-%d/%d" % (first, last, size)
+    if response.status != 206 or response.info()["Content-Range"] != content_range:
+        response.close()
+        raise OSError("server didn't send the range %d-%d" % (first, last))
+    return response
+
+
+def copy_range(response, destfile, segment):
+    """Write the segment sent in response at its offset in destfile"""
+    offset, last = segment
+    buffer = bytearray(COPY_BUFFER_SIZE)
+    view = memoryview(buffer)
+    with response:
+        while offset <= last:
+            read = response.readinto(view[: min(COPY_BUFFER_SIZE, last - offset + 1)])
+            if not read:
+                raise OSError("segment %d-%d truncated at %d" % (segment + (offset,)))
+            written = 0
+            while written < read:
+                written += os.pwrite(destfile, view[written:read], offset + written)
+            offset += read
+    return segment[1] - segment[0] + 1
+
+
+def download_segments(url, destfile, size, etag, connections):
+    """Download the size bytes of url into the destfile descriptor"""
+    count = max(1, min(connections, size // SEGMENT_MIN_SIZE))
+    bounds = [size * i // count for i in range(count + 1)]
+    segments = [(bounds[i], bounds[i + 1] - 1) for i in range(count)]
+
+    if hasattr(os, "posix_fallocate"):
+        os.posix_fallocate(destfile, 0, size)
+    else:
+        os.ftruncate(destfile, size)
+
+    with concurrent.futures.ThreadPoolExecutor(count) as pool:
+        # Only the last segment counts as a download on a wurf server, and
+        # the server stops accepting connections once its count is used up:
+        # every other segment has to be under way before asking for it.
+        responses = list(
+            pool.map(lambda segment: open_range(url, segment, size, etag), segments[:-1])
+        )
+        responses.append(open_range(url, segments[-1], size, etag))
+        received = sum(
+            pool.map(copy_range, responses, itertools.repeat(destfile), segments)
+        )
+
+    if received != size or os.fstat(destfile).st_size != size:
+        raise OSError("downloaded %d bytes out of %d" % (received, size))
+    return received
+
+
+def verify_digest(destfilename, digest, expected):
+    if expected is not None and digest.digest() != expected:
+        raise OSError(
+            "%s is corrupt: its SHA-256 digest doesn't match the server's"
+            % destfilename
+        )
+    print("sha-256 %s%s" % (digest.hexdigest(), " verified" if expected else ""))
+
+
+# With --delta, an existing copy of a file is updated instead of downloaded
+# again. The client fetches the manifest of the file and looks for its
+# blocks in the local copy: first where they were, then a byte at a time
+# from where a block doesn't match, so that blocks moved by an insertion
+# or a deletion are found too. The rolling search runs in Python, so it
+# gives up after DELTA_ROLL_LIMIT bytes and only looks for blocks in place
+# from then on, which keeps an unrelated local file from taking ages.
+# The missing blocks are downloaded in ranges into a new file, along with
+# the last block: a ranged request only counts as a download when it
+# includes the end of the file. Ranges less than DELTA_MERGE_GAP apart
+# are merged, fetching a little more in fewer requests. The new file is
+# checked against the SHA-256 digest of the manifest before taking the
+# place of the old one.
+
+DELTA_ROLL_LIMIT = 8 * 1024 * 1024
+DELTA_MERGE_GAP = 1024 * 1024
+
+
+def find_blocks(fd: int, block_size: int, blocks) -> dict[int, int]:
+    """Find the full blocks of a manifest in the file open as fd
+
+    Returns the offset where each block found is, by its index.
+    """
+    index = {}
+    for i, (weak, strong) in enumerate(blocks):
+        index.setdefault(weak, []).append(i)
+    found = {}
+
+    def claim(data, weak, offset):
+        strong = hashlib.blake2b(data, digest_size=16).digest()
+        matched = False
+        for i in index[weak]:
+            if blocks[i][1] == strong:
+                found.setdefault(i, offset)
+                matched = True
+        return matched
+
+    size = os.fstat(fd).st_size
+    offset = rolled = 0
+    while offset + block_size <= size:
+        block = os.pread(fd, block_size, offset)
+        weak = zlib.adler32(block)
+        if weak in index and claim(block, weak, offset):
+            offset += block_size
+            continue
+        window = block + os.pread(fd, block_size, offset + block_size)
+        steps = len(window) - block_size
+        if rolled >= DELTA_ROLL_LIMIT or not steps:
+            offset += block_size
+            continue
+        # The Adler-32 checksum of the window one byte further along.
+        a, b = weak & 0xFFFF, weak >> 16
+        for start in range(1, steps + 1):
+            out = window[start - 1]
+            a = (a - out + window[start + block_size - 1]) % 65521
+            b = (b - block_size * out - 1 + a) % 65521
+            weak = b << 16 | a
+            if weak in index and claim(window[start : start + block_size], weak, offset + start):
+                offset += start + block_size
+                break
+        else:
+            offset += steps + 1
+        rolled += start
+    return found
+
+
+def open_no_redirect(url):
+    """Open url, raising HTTPError instead of following a redirect
+
+    Servers without manifests or swarms redirect the requests for them to
+    the file itself, which would start (and count) a download.
+    """
+    import urllib.request
+
+    class NoRedirectHandler(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, req, fp, code, msg, headers, newurl):
+            return None
+
+    return urllib.request.build_opener(NoRedirectHandler).open(url)
+
+
+def fetch_manifest(url) -> bytes | None:
+    """Download the manifest of the file at url, None if there's none"""
+    import urllib.error
+
+    try:
+        with open_no_redirect(urllib.parse.urlsplit(url)._replace(query="manifest").geturl()) as f:
+            if f.info().get_content_type() != MANIFEST_TYPE:
+                return None
+            return f.read()
+    except urllib.error.HTTPError:
+        return None
+
+
+def delta_update(url, destfilename, size, etag, last_modified, connections):
+    """Update the destfilename copy of url, downloading the changed blocks
+
+    Returns the number of bytes downloaded, None if the server doesn't send
+    manifests.
+    """
+    import tempfile
+
+    manifest = fetch_manifest(url)
+    if manifest is None:
+        return None
+    try:
+        block_size, manifest_size, digest, blocks = parse_manifest(manifest)
+    except (ValueError, struct.error) as ex:
+        raise OSError("invalid manifest: %s" % ex)
+    if manifest_size != size:
+        raise OSError("%s changed on the server, try again" % url)
+
+    with open(destfilename, "rb") as local:
+        found = find_blocks(local.fileno(), block_size, blocks)
+        found.pop(len(blocks) - 1, None)
+        segments = []
+        for i in range(len(blocks)):
+            if i in found:
+                continue
+            first = i * block_size
+            last = min(first + block_size, size) - 1
+            if segments and first - segments[-1][1] <= DELTA_MERGE_GAP:
+                segments[-1] = (segments[-1][0], last)
+            else:
+                segments.append((first, last))
+
+        destdir = os.path.dirname(destfilename) or "."
+        destfile, tmpname = tempfile.mkstemp(
+            prefix=os.path.basename(destfilename) + ".", dir=destdir
+        )
+
+        def fetch(segment):
+            return copy_range(open_range(url, segment, size, etag), destfile, segment)
+
+        try:
+            try:
+                os.fchmod(destfile, os.fstat(local.fileno()).st_mode & 0o7777)
+                if hasattr(os, "posix_fallocate"):
+                    os.posix_fallocate(destfile, 0, size)
+                else:
+                    os.ftruncate(destfile, size)
+                for i, offset in found.items():
+                    block = os.pread(local.fileno(), block_size, offset)
+                    written = 0
+                    while written < len(block):
+                        written += os.pwrite(
+                            destfile, block[written:], i * block_size + written
+                        )
+                received = 0
+                if segments:
+                    with concurrent.futures.ThreadPoolExecutor(connections) as pool:
+                        received = sum(pool.map(fetch, segments[:-1]))
+                    received += fetch(segments[-1])
+                if last_modified:
+                    mtime = email.utils.parsedate_to_datetime(last_modified).timestamp()
+                    os.utime(destfile, (time.time(), mtime))
+            finally:
+                os.close(destfile)
+            print(
+                "reused %d blocks of %d, downloaded %d of %d bytes"
+                % (len(found), len(blocks), received, size)
+            )
+            verify_digest(destfilename, sha256_file(tmpname), digest)
+            os.replace(tmpname, destfilename)
+        except BaseException:
+            os.unlink(tmpname)
+            raise
+    return received
+
+
+# With --swarm, the client joins the swarm of a server started with --swarm.
+# It serves the chunks it has to the other peers, on a port of its own,
+# while it fetches the others: the chunks the server hands out to it from
+# the server, the rest from the peers that have them, the rarest first.
+# Every chunk is checked against its checksum before it's written or passed
+# on, and a peer sending a bad chunk or none is dropped. A chunk that no
+# peer will send comes from the server. The last chunk always comes from
+# the server, last, so that the download counts there. Once done, the
+# client stays on to serve up to <count> copies of the file, until no peer
+# asked for a chunk for SWARM_LINGER seconds.
+
+SWARM_FETCHES = 4
+SWARM_ANNOUNCE_INTERVAL = 1
+SWARM_ANNOUNCE_MIN_INTERVAL = 0.25
+SWARM_LINGER = 5
+
+
+class PeerHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the chunks of a swarm peer, at /<index>"""
+
+    timeout = TRANSFER_TIMEOUT
+
+    def do_GET(self):
+        try:
+            index = int(self.path.strip("/"))
+        except ValueError:
+            index = -1
+        data = self.server.peer.read_chunk(index)
+        if data is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SwarmPeer:
+    def __init__(self, destfilename: str, destfile: int, document: dict, budget: int):
+        self.destfile = destfile
+        self.reader = os.open(destfilename, os.O_RDONLY)
+        self.size = document["size"]
+        self.chunk_size = document["chunk_size"]
+        self.chunks = [bytes.fromhex(chunk) for chunk in document["chunks"]]
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.have = 0
+        self.uploaded = 0
+        self.last_request = time.monotonic()
+        self.server = http.server.ThreadingHTTPServer(("", 0), PeerHandler)
+        # Closing the server waits for the chunks being sent.
+        self.server.daemon_threads = False
+        self.server.peer = self
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def chunk_range(self, index: int) -> tuple[int, int]:
+        first = index * self.chunk_size
+        return first, min(first + self.chunk_size, self.size) - 1
+
+    def read_chunk(self, index: int) -> bytes | None:
+        """The data of a chunk for another peer, None if it can't have it"""
+        with self.lock:
+            self.last_request = time.monotonic()
+            if not 0 <= index < len(self.chunks) or not self.have >> index & 1:
+                return None
+            if self.uploaded >= self.budget:
+                return None
+            first, last = self.chunk_range(index)
+            self.uploaded += last - first + 1
+        return os.pread(self.reader, last - first + 1, first)
+
+    def store(self, index: int, data: bytes) -> bool:
+        """Write a chunk if it matches its checksum"""
+        first, last = self.chunk_range(index)
+        if len(data) != last - first + 1:
+            return False
+        if hashlib.blake2b(data, digest_size=16).digest() != self.chunks[index]:
+            return False
+        written = 0
+        while written < len(data):
+            written += os.pwrite(self.destfile, data[written:], first + written)
+        with self.lock:
+            self.have |= 1 << index
+        return True
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        os.close(self.reader)
+
+
+def fetch_swarm(url) -> dict | None:
+    """Download the swarm document of the server of url, None if there's none"""
+    import urllib.error
+
+    try:
+        with open_no_redirect(urllib.parse.urljoin(url, SWARM_PATH)) as f:
+            if f.info().get_content_type() != "application/json":
+                return None
+            return json.load(f)
+    except (urllib.error.HTTPError, ValueError):
+        return None
+
+
+def swarm_download(url, destfilename, destfile, size, etag, document, connections, count):
+    """Download url into the destfile descriptor with the help of a swarm"""
+    import urllib.request, random
+
+    if document["size"] != size:
+        raise OSError("%s changed on the server, try again" % url)
+    if hasattr(os, "posix_fallocate"):
+        os.posix_fallocate(destfile, 0, size)
+    else:
+        os.ftruncate(destfile, size)
+
+    peer = SwarmPeer(destfilename, destfile, document, count * size)
+    last_chunk = len(peer.chunks) - 1
+    fetches = max(connections, SWARM_FETCHES)
+    failed = set()
+    sources = collections.Counter()
+
+    def announce(want, leave=False):
+        request = urllib.request.Request(
+            urllib.parse.urljoin(url, SWARM_PATH),
+            json.dumps(
+                {"port": peer.port, "have": "%x" % peer.have, "want": want, "leave": leave}
+            ).encode("utf-8"),
+            {"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(request, timeout=TRANSFER_TIMEOUT) as f:
+            return json.load(f)
+
+    def fetch(index, source):
+        try:
+            if source is None:
+                with open_range(url, peer.chunk_range(index), size, etag) as f:
+                    data = f.read()
+            else:
+                with urllib.request.urlopen(source + str(index), timeout=TRANSFER_TIMEOUT) as f:
+                    data = f.read()
+        except OSError:
+            if source is None:
+                raise
+            data = b""
+        if not peer.store(index, data):
+            if source is None:
+                raise OSError("chunk %d from the server doesn't match its checksum" % index)
+            failed.add(source)
+            return None
+        return "server" if source is None else "peers"
+
+    print("joining the swarm on port %d" % peer.port)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(fetches) as pool:
+            pending = {}
+            wanted = (1 << last_chunk) - 1
+            announced = 0
+            while peer.have & wanted != wanted:
+                if time.monotonic() - announced >= SWARM_ANNOUNCE_MIN_INTERVAL:
+                    answer = announce(fetches - len(pending))
+                    announced = time.monotonic()
+                busy = set(pending.values())
+                missing = [
+                    index
+                    for index in range(last_chunk)
+                    if not peer.have >> index & 1 and index not in busy
+                ]
+                holders = {index: [] for index in missing}
+                listed = set()
+                for other in answer["peers"]:
+                    other_have = int(other["have"], 16)
+                    for index in missing:
+                        if other_have >> index & 1:
+                            listed.add(index)
+                            if other["url"] not in failed:
+                                holders[index].append(other["url"])
+                # Chunks handed out by the server are fetched once, even when
+                # the answer is planned with again before the next announce.
+                plan = [(index, None) for index in answer["assign"] if index in holders]
+                answer["assign"] = []
+                random.shuffle(missing)
+                missing.sort(key=lambda index: len(holders[index]))
+                for index in missing:
+                    if holders[index]:
+                        plan.append((index, random.choice(holders[index])))
+                    elif index in listed:
+                        plan.append((index, None))
+                for index, source in plan:
+                    if len(pending) >= fetches:
+                        break
+                    if index not in pending.values():
+                        pending[pool.submit(fetch, index, source)] = index
+                if not pending:
+                    time.sleep(SWARM_ANNOUNCE_MIN_INTERVAL)
+                done, _ = concurrent.futures.wait(
+                    pending,
+                    timeout=SWARM_ANNOUNCE_INTERVAL,
+                    return_when=concurrent.futures.FIRST_COMPLETED,
+                )
+                for future in done:
+                    del pending[future]
+                    sources[future.result()] += 1
+        sources[fetch(last_chunk, None)] += 1
+        print(
+            "fetched %d chunks from the server and %d from peers"
+            % (sources["server"], sources["peers"])
+        )
+        verify_digest(destfilename, sha256_file(destfilename), bytes.fromhex(document["digest"]))
+
+        # Serve the other peers for a while, as long as they ask for chunks
+        # and the server is there.
+        peer.last_request = time.monotonic()
+        while peer.uploaded < peer.budget and (
+            time.monotonic() - peer.last_request < SWARM_LINGER
+        ):
+            try:
+                announce(0)
+            except OSError:
+                break
+            time.sleep(SWARM_ANNOUNCE_INTERVAL)
+    finally:
+        try:
+            announce(0, leave=True)
+        except OSError:
+            pass
+        peer.close()
+    print("served %d bytes to peers" % peer.uploaded)
+
+
+# With -x, the client unpacks a directory archive as it downloads it.
+# A thread reads and decompresses the network stream READ_AHEAD_CHUNKS
+# chunks ahead, while the main thread unpacks members and writes files.
+# The archives of a wurf server are made of several compressed streams,
+# compressed in parallel: they're read with the file classes of gzip, bz2
+# and lzma, which go on to the next stream, unlike tarfile's own "r|*".
+# Tar streams are unpacked member by member. A zip file can only be read
+# from its central directory, at its end: it's spooled, in memory up to
+# ZIP_SPOOL_SIZE bytes and on disk beyond, then extracted.
+# Either way, members are extracted under the target directory, which
+# takes the place of the top directory of the archive, and members that
+# would land outside of it are skipped.
+
+ARCHIVE_EXTENSIONS = (".tar.gz", ".tgz", ".tar.bz2", ".tar.xz", ".tar", ".zip")
+READ_AHEAD_CHUNKS = 16
+ZIP_SPOOL_SIZE = 64 * 1024 * 1024
+
+
+def archive_stem(fname: str) -> str | None:
+    """Returns fname without its archive extension, None if not an archive"""
+    for ext in ARCHIVE_EXTENSIONS:
+        if fname.lower().endswith(ext) and len(fname) > len(ext):
+            return fname[: -len(ext)]
+    return None
+
+
+class ReadAhead:
+    """File-like object reading fileobj on a thread, ahead of its reader"""
+
+    def __init__(self, fileobj: BinaryIO):
+        self.fileobj = fileobj
+        self.chunks = queue.Queue(READ_AHEAD_CHUNKS)
+        self.buffer = memoryview(b"")
+        self.done = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            for chunk in iter(lambda: self.fileobj.read(COPY_BUFFER_SIZE), b""):
+                self.chunks.put(chunk)
+            self.chunks.put(b"")
+        except Exception as ex:
+            self.chunks.put(ex)
+
+    def read(self, size=-1):
+        output = []
+        while size != 0 and not self.done:
+            if not self.buffer:
+                chunk = self.chunks.get()
+                if isinstance(chunk, Exception):
+                    raise chunk
+                if not chunk:
+                    self.done = True
+                    break
+                self.buffer = memoryview(chunk)
+            piece = self.buffer if size < 0 else self.buffer[:size]
+            self.buffer = self.buffer[len(piece) :]
+            output.append(piece)
+            if size > 0:
+                size -= len(piece)
+        return b"".join(output)
+
+
+def member_path(name: str, stem: str) -> str | None:
+    """Path of an archive member under the target directory
+
+    Returns None for the top directory itself. Raises ValueError for
+    members with an absolute path or going up with "..".
+    """
+    if name.startswith(("/", "\\")):
+        raise ValueError("absolute path")
+    parts = [part for part in name.replace("\\", "/").split("/") if part not in ("", ".")]
+    if ".." in parts:
+        raise ValueError("path outside of the archive")
+    if parts and parts[0] == stem:
+        parts = parts[1:]
+    return "/".join(parts) if parts else None
+
+
+def decompressed(fileobj: BinaryIO, fname: str) -> BinaryIO:
+    """File-like object reading fileobj, decompressed as told by fname"""
+    fname = fname.lower()
+    if fname.endswith((".tar.gz", ".tgz")):
+        import gzip
+
+        return gzip.GzipFile(fileobj=fileobj)
+    if fname.endswith(".tar.bz2"):
+        import bz2
+
+        return bz2.BZ2File(fileobj)
+    if fname.endswith(".tar.xz"):
+        import lzma
+
+        return lzma.LZMAFile(fileobj)
+    return fileobj
+
+
+def extract_tar(stream: BinaryIO, target: str, stem: str) -> tuple[int, int]:
+    """Extract a tar stream, returns the number of files and bytes"""
+    import tarfile
+
+    files = size = 0
+    with tarfile.open(fileobj=stream, mode="r|") as tfile:
+        for member in tfile:
+            try:
+                path = member_path(member.name, stem)
+                if path is None:
+                    continue
+                if member.islnk():
+                    member.linkname = member_path(member.linkname, stem) or ""
+                member.name = path
+                if hasattr(tarfile, "data_filter"):
+                    tfile.extract(member, target, filter="data")
+                elif member.isfile() or member.isdir():
+                    tfile.extract(member, target)
+                else:
+                    raise tarfile.TarError("not a regular file or directory")
+            except (ValueError, tarfile.TarError) as ex:
+                print("skipping %s: %s" % (member.name, ex), file=sys.stderr)
+                continue
+            if member.isfile():
+                files += 1
+                size += member.size
+    return files, size
+
+
+def extract_zip(stream: BinaryIO, target: str, stem: str) -> tuple[int, int]:
+    """Extract a zip file read from stream, returns its files and bytes"""
+    import tempfile, zipfile
+
+    files = size = 0
+    with tempfile.SpooledTemporaryFile(ZIP_SPOOL_SIZE) as spool:
+        shutil.copyfileobj(stream, spool, COPY_BUFFER_SIZE)
+        with zipfile.ZipFile(spool) as zfile:
+            for info in zfile.infolist():
+                try:
+                    path = member_path(info.filename, stem)
+                except ValueError as ex:
+                    print("skipping %s: %s" % (info.filename, ex), file=sys.stderr)
+                    continue
+                if path is None:
+                    continue
+                info.filename = path + ("/" if info.is_dir() else "")
+                zfile.extract(info, target)
+                if not info.is_dir():
+                    files += 1
+                    size += info.file_size
+    return files, size
+
+
+def ask(question: str, default: str, batch: bool) -> str:
+    """Ask the user, suggesting default; in batch mode, take default"""
+    if batch:
+        return default
+    import readline
+
+    readline.set_startup_hook(lambda: readline.insert_text(default))
+    try:
+        return input(question)
+    finally:
+        readline.set_startup_hook(None)
+
+
+def confirm(question: str, default: bool, batch: bool) -> bool:
+    """Ask the user a yes or no question; in batch mode, take default"""
+    if batch:
+        return default
+    return input(question).lower() in ["y", "yes"]
+
+
+def extract_download(url, f, fname, stem, batch):
+    """Download the fname archive from url, extracting it on the fly
+
+    f is the response to a GET request already made, if any.
+    """
+    import urllib.request
+
+    target = ask("Enter target directory: ", stem, batch)
+    if os.path.lexists(target) and not (
+        os.path.isdir(target)
+        and confirm("Directory exists. Extract into it (y/n)? ", False, batch)
+    ):
+        for suffix in [".1", ".2", ".3", ".4", ".5", ".6", ".7", ".8", ".9"]:
+            if not os.path.lexists(target + suffix):
+                target += suffix
+                break
+        else:
+            raise OSError("no free directory name for %s" % target)
+        print("alternate directory is:", target)
+    os.makedirs(target, exist_ok=True)
+
+    if f is None:
+        f = urllib.request.urlopen(url)
+    print("extracting: %s -> %s" % (fname, target))
+    with f:
+        if fname.lower().endswith(".zip"):
+            files, size = extract_zip(ReadAhead(f), target, stem)
+        else:
+            files, size = extract_tar(ReadAhead(decompressed(f, fname)), target, stem)
+    print("extracted %d files, %d bytes" % (files, size))
+    return 1
+
+
+def wurf_client(
+    url, connections=1, extract=False, batch=False, delta=False, swarm=False, count=1
+):
+    # The import binds urllib in this function, it has to come first.
+    import urllib.request, urllib.error
+    import tempfile, gzip
+
     urlparts = urllib.parse.urlparse(url, "http")
     if urlparts[0] not in ["http", "https"] or urlparts[1] == "":
         return None
 
+    # urllib turns a redirected HEAD request into a GET, which would start
+    # (and count) a download on a wurf server.
+
+    class HeadRedirectHandler(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, req, fp, code, msg, headers, newurl):
+            request = super().redirect_request(req, fp, code, msg, headers, newurl)
+            if request is not None and req.get_method() == "HEAD":
+                request.method = "HEAD"
+            return request
+
     fname = None
 
-    f = urllib.request.urlopen(url)
+    # Ask for the metadata first, so a partial local copy can be resumed
+    # instead of downloaded again. Servers without HEAD support get a
+    # plain GET instead.
+
+    f = None
+    try:
+        opener = urllib.request.build_opener(HeadRedirectHandler)
+        with opener.open(urllib.request.Request(url, method="HEAD")) as head:
+            f_meta = head.info()
+            url = head.geturl()
+    except urllib.error.HTTPError:
+        f = urllib.request.urlopen(url)
+        f_meta = f.info()
+        url = f.geturl()
 
-    f_meta = f.info()
     disp = f_meta["Content-Disposition"]
 
     if disp:
@@ -444,7 +4311,6 @@ def wurf_client(url):
             fname = None
 
     if fname == None:
-        url = f.geturl()
         urlparts = urllib.parse.urlparse(url)
         fname = urlparts[2]
 
@@ -455,11 +4321,21 @@ def wurf_client(url):
         fname = urllib.parse.unquote(fname)
         fname = os.path.basename(fname)
 
-    readline.set_startup_hook(lambda: readline.insert_text(fname))
-    fname = input("Enter target filename: ")
-    readline.set_startup_hook(None)
+    stem = archive_stem(fname) if extract else None
+    if extract and stem is None:
+        print("%s is not an archive, downloading it as it is" % fname)
+    if stem is not None:
+        return extract_download(url, f, fname, stem, batch)
+
+    fname = ask("Enter target filename: ", fname, batch)
+
+    size = None
+    if f_meta["Content-Length"] and not f_meta["Content-Encoding"]:
+        size = int(f_meta["Content-Length"])
+    resumable = f is None and size and f_meta["Accept-Ranges"] == "bytes"
 
     override = False
+    resume_from = 0
 
     destfile = None
     destfilename = os.path.join(".", fname)
@@ -467,8 +4343,32 @@ def wurf_client(url):
         destfile = os.open(destfilename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
     except OSError as e:
         if e.errno == errno.EEXIST:
-            override = input("File exists. Overwrite (y/n)? ")
-            override = override.lower() in ["y", "yes"]
+            local_size = os.path.getsize(destfilename)
+            if delta and resumable and f_meta["ETag"] and os.path.isfile(destfilename):
+                print("updating file: %s -> %s" % (fname, destfilename))
+                if (
+                    delta_update(
+                        url,
+                        destfilename,
+                        size,
+                        f_meta["ETag"],
+                        f_meta["Last-Modified"],
+                        connections,
+                    )
+                    is not None
+                ):
+                    return 1
+                print("the server sends no block manifest, downloading the whole file")
+            if resumable and 0 < local_size < size:
+                question = "File exists with %d of %d bytes. Resume (y/n)? " % (
+                    local_size,
+                    size,
+                )
+                if confirm(question, True, batch):
+                    override = True
+                    resume_from = local_size
+            if not override:
+                override = confirm("File exists. Overwrite (y/n)? ", False, batch)
         else:
             raise
 
@@ -492,19 +4392,106 @@ def wurf_client(url):
                 destfile, destfilename = tempfile.mkstemp(prefix=fname + ".", dir=".")
             print("alternate filename is:", destfilename)
 
-    print("downloading file: %s -> %s" % (fname, destfilename))
-
-    shutil.copyfileobj(f, os.fdopen(destfile, "wb"))
+    etag = f_meta["ETag"]
+    document = None
+    if swarm and f is None and not resume_from and etag and resumable:
+        document = fetch_swarm(url)
+        if document is None:
+            print("the server runs no swarm, downloading the file from it")
+    if document is not None:
+        print("downloading file: %s -> %s with the swarm" % (fname, destfilename))
+        try:
+            swarm_download(
+                url, destfilename, destfile, size, etag, document, connections, count
+            )
+        finally:
+            os.close(destfile)
+        if f_meta["Last-Modified"]:
+            mtime = email.utils.parsedate_to_datetime(f_meta["Last-Modified"])
+            os.utime(destfilename, (time.time(), mtime.timestamp()))
+        return 1
+
+    if f is None and not resume_from and connections > 1 and etag and resumable:
+        print(
+            "downloading file: %s -> %s over %d connections"
+            % (fname, destfilename, connections)
+        )
+        try:
+            download_segments(url, destfile, size, etag, connections)
+        finally:
+            os.close(destfile)
+        if f_meta["Last-Modified"]:
+            mtime = email.utils.parsedate_to_datetime(f_meta["Last-Modified"])
+            os.utime(destfilename, (time.time(), mtime.timestamp()))
+        # The segments arrive out of order, so they're hashed afterwards.
+        verify_digest(destfilename, sha256_file(destfilename), parse_digest(f_meta))
+        return 1
+
+    if f is None:
+        request = urllib.request.Request(url)
+        if resume_from:
+            # The partial file carries the Last-Modified date of the
+            # version it comes from, so the server only sends the rest of
+            # the file if it didn't change since.
+            request.add_header("Range", "bytes=%d-" % resume_from)
+            request.add_header(
+                "If-Range",
+                email.utils.formatdate(os.stat(destfile).st_mtime, usegmt=True),
+            )
+        else:
+            request.add_header("Accept-Encoding", "gzip")
+        f = urllib.request.urlopen(request)
 
+    if f.status == 206:
+        print("resuming file: %s -> %s at byte %d" % (fname, destfilename, resume_from))
+        os.lseek(destfile, resume_from, os.SEEK_SET)
+    else:
+        print("downloading file: %s -> %s" % (fname, destfilename))
+
+    # The digest of a gzip encoded download is the one of the plain file,
+    # given with the HEAD answer for the same version of the file.
+    info = f.info()
+    expected = parse_digest(info)
+    if expected is None and info["ETag"] and info["Content-Encoding"] == "gzip":
+        if info["ETag"] == (f_meta["ETag"] or "")[:-1] + '-gzip"':
+            expected = parse_digest(f_meta)
+
+    # The digest covers the whole file, including what was already there.
+    digest = hashlib.sha256()
+    if f.status == 206:
+        sha256_file(destfilename, digest)
+
+    last_modified = info["Last-Modified"]
+    if info["Content-Encoding"] in ("gzip", "x-gzip"):
+        f = gzip.GzipFile(fileobj=f)
+    with os.fdopen(destfile, "wb") as writefile:
+        try:
+            for chunk in iter(lambda: f.read(COPY_BUFFER_SIZE), b""):
+                digest.update(chunk)
+                writefile.write(chunk)
+        finally:
+            writefile.truncate()
+            writefile.flush()
+            if last_modified:
+                mtime = email.utils.parsedate_to_datetime(last_modified).timestamp()
+                os.utime(writefile.fileno(), (time.time(), mtime))
+
+    verify_digest(destfilename, digest, expected)
     return 1
 
 
 def main():
-    global cpid, upload, compressed, tls, cert, key, keypass
+    global maxtransfers, workers, rate, client_rate, upload, browse
+    global compressed, encoding, level, cache, threads
+    global tls, cert, key, keypass, tracer, profile_dir, discover, swarm
 
     maxdown = 1
     port = 8080
     ip_addr = ""
+    connections = 1
+    extract = False
+    batch = False
+    delta = False
 
     config = configparser.ConfigParser()
     config.read(
@@ -531,6 +4518,7 @@ def main():
             "true": "gz",
             "bz": "bz2",
             "bz2": "bz2",
+            "xz": "xz",
             "zip": "zip",
             "off": "",
             "false": "",
@@ -538,6 +4526,85 @@ def main():
         compressed = config.get("main", "compressed")
         compressed = formats.get(compressed, "gz")
 
+    if config.has_option("main", "transfers"):
+        try:
+            maxtransfers = config.getint("main", "transfers")
+            if maxtransfers <= 0:
+                raise ValueError
+        except ValueError:
+            config_error(
+                "number of transfers", config.get("main", "transfers"), "an integer > 0"
+            )
+
+    for option in ("rate", "client_rate"):
+        if config.has_option("main", option):
+            try:
+                if option == "rate":
+                    rate = parse_rate(config.get("main", option))
+                else:
+                    client_rate = parse_rate(config.get("main", option))
+            except ValueError:
+                config_error(
+                    option.replace("_", " "),
+                    config.get("main", option),
+                    "a number of bytes per second > 0, optionally followed by k, M or G",
+                )
+
+    if config.has_option("main", "level"):
+        try:
+            level = config.getint("main", "level")
+            if not 0 <= level <= 9:
+                raise ValueError
+        except ValueError:
+            config_error(
+                "compression level", config.get("main", "level"), "an integer between 0 and 9"
+            )
+
+    if config.has_option("main", "threads"):
+        try:
+            threads = config.getint("main", "threads")
+            if threads <= 0:
+                raise ValueError
+        except ValueError:
+            config_error("number of threads", config.get("main", "threads"), "an integer > 0")
+
+    if config.has_option("main", "workers"):
+        try:
+            workers = config.getint("main", "workers")
+            if workers <= 0:
+                raise ValueError
+        except ValueError:
+            config_error("number of workers", config.get("main", "workers"), "an integer > 0")
+
+    if config.has_option("main", "cache"):
+        cache_modes = {
+            "on": "on",
+            "true": "on",
+            "off": "off",
+            "false": "off",
+            "prebuild": "prebuild",
+        }
+        cache = cache_modes.get(config.get("main", "cache"), "on")
+
+    if config.has_option("main", "encoding"):
+        encodings = {
+            "gzip": "gzip",
+            "gz": "gzip",
+            "true": "gzip",
+            "off": "off",
+            "false": "off",
+        }
+        encoding = encodings.get(config.get("main", "encoding"), "off")
+
+    if config.has_option("main", "discover"):
+        discover = config.getboolean("main", "discover")
+
+    if config.has_option("main", "browse"):
+        browse = config.getboolean("main", "browse")
+
+    if config.has_option("main", "swarm"):
+        swarm = config.getboolean("main", "swarm")
+
     if config.has_option("main", "tls"):
         affirm = {
             "yes": True,
@@ -563,7 +4630,7 @@ def main():
     defaultmaxdown = maxdown
 
     try:
-        options, filenames = getopt.gnu_getopt(sys.argv[1:], "hUszjZuti:c:p:", ["cert=", "key=", "keypass="])
+        options, filenames = getopt.gnu_getopt(sys.argv[1:], "hUbszjJZuxti:c:p:n:", ["cert=", "key=", "keypass=", "transfers=", "workers=", "rate=", "client-rate=", "level=", "cache=", "threads=", "encoding=", "trace=", "profile=", "no-discover", "batch", "delta", "swarm"])
     except getopt.GetoptError as desc:
         usage(defaultport, defaultmaxdown, desc)
 
@@ -584,6 +4651,74 @@ def main():
         elif option == "-i":
             ip_addr = val
 
+        elif option == "-n":
+            try:
+                connections = int(val)
+                if connections <= 0:
+                    raise ValueError
+            except ValueError:
+                usage(
+                    defaultport,
+                    defaultmaxdown,
+                    "invalid number of connections: %r. "
+                    "Please specify an integer > 0." % val,
+                )
+
+        elif option == "--transfers":
+            try:
+                maxtransfers = int(val)
+                if maxtransfers <= 0:
+                    raise ValueError
+            except ValueError:
+                usage(
+                    defaultport,
+                    defaultmaxdown,
+                    "invalid number of transfers: %r. "
+                    "Please specify an integer > 0." % val,
+                )
+
+        elif option in ("--rate", "--client-rate"):
+            try:
+                if option == "--rate":
+                    rate = parse_rate(val)
+                else:
+                    client_rate = parse_rate(val)
+            except ValueError:
+                usage(
+                    defaultport,
+                    defaultmaxdown,
+                    "invalid rate: %r. Please specify a number of bytes per "
+                    "second > 0, optionally followed by k, M or G." % val,
+                )
+
+        elif option == "-x":
+            extract = True
+
+        elif option == "--batch":
+            batch = True
+
+        elif option == "--delta":
+            delta = True
+
+        elif option == "--swarm":
+            swarm = True
+
+        elif option == "--no-discover":
+            discover = False
+
+        elif option == "--trace":
+            try:
+                tracer = Tracer(val)
+            except OSError as ex:
+                usage(defaultport, defaultmaxdown, "cannot open trace file: %s" % ex)
+
+        elif option == "--profile":
+            try:
+                os.makedirs(val, exist_ok=True)
+            except OSError as ex:
+                usage(defaultport, defaultmaxdown, "cannot create profile directory: %s" % ex)
+            profile_dir = val
+
         elif option == "-p":
             try:
                 port = int(val)
@@ -600,6 +4735,9 @@ def main():
         elif option == "-h":
             usage(defaultport, defaultmaxdown)
 
+        elif option == "-b":
+            browse = True
+
         elif option == "-U":
             upload = True
 
@@ -607,11 +4745,71 @@ def main():
             compressed = "gz"
         elif option == "-j":
             compressed = "bz2"
+        elif option == "-J":
+            compressed = "xz"
         elif option == "-Z":
             compressed = "zip"
         elif option == "-u":
             compressed = ""
 
+        elif option == "--level":
+            try:
+                level = int(val)
+                if not 0 <= level <= 9:
+                    raise ValueError
+            except ValueError:
+                usage(
+                    defaultport,
+                    defaultmaxdown,
+                    "invalid compression level: %r. "
+                    "Please specify an integer between 0 and 9." % val,
+                )
+
+        elif option == "--threads":
+            try:
+                threads = int(val)
+                if threads <= 0:
+                    raise ValueError
+            except ValueError:
+                usage(
+                    defaultport,
+                    defaultmaxdown,
+                    "invalid number of threads: %r. "
+                    "Please specify an integer > 0." % val,
+                )
+
+        elif option == "--workers":
+            try:
+                workers = int(val)
+                if workers <= 0:
+                    raise ValueError
+            except ValueError:
+                usage(
+                    defaultport,
+                    defaultmaxdown,
+                    "invalid number of workers: %r. "
+                    "Please specify an integer > 0." % val,
+                )
+
+        elif option == "--cache":
+            if val not in ["on", "off", "prebuild"]:
+                usage(
+                    defaultport,
+                    defaultmaxdown,
+                    "invalid cache mode: %r. "
+                    "Please specify on, off or prebuild." % val,
+                )
+            cache = val
+
+        elif option == "--encoding":
+            if val not in ["gzip", "off"]:
+                usage(
+                    defaultport,
+                    defaultmaxdown,
+                    "invalid encoding: %r. Please specify gzip or off." % val,
+                )
+            encoding = val
+
         elif option == "-t":
             tls = True
             if '-p' not in dict(options) and not config.has_option("main", "port"):
@@ -637,7 +4835,12 @@ def main():
 
     else:
         if len(filenames) == 1:
-            if wurf_client(filenames[0]) != None:
+            if (
+                wurf_client(
+                    filenames[0], connections, extract, batch, delta, swarm, maxdown
+                )
+                != None
+            ):
                 sys.exit(0)
 
             filename = os.path.abspath(filenames[0])
@@ -660,6 +4863,17 @@ def main():
                 "%s: Neither file nor directory" % filenames[0],
             )
 
+        if swarm and not os.path.isfile(filename):
+            usage(defaultport, defaultmaxdown, "--swarm can only serve a single file.")
+
+        # The peers of a swarm are only known to the worker they announce to.
+        if swarm and workers > 1:
+            usage(
+                defaultport,
+                defaultmaxdown,
+                "--swarm can't run with --workers, nor swarm with workers in the wurfrc.",
+            )
+
     if tls:
         if cert == "" or key == "":
             usage(
@@ -670,14 +4884,6 @@ def main():
 
     serve_files(filename, maxdown, ip_addr, port)
 
-    # wait for child processes to terminate
-    if cpid != 0:
-        try:
-            while 1:
-                os.wait()
-        except OSError:
-            pass
-
 
 if __name__ == "__main__":
     try: